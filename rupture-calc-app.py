@@ -1,109 +1,18 @@
 import tkinter as tk
 from tkinter import filedialog, ttk
 from tkinter import *
-import pandas as pd
-import numpy as np
-import csv
-from openquake.hazardlib.geo import (
-    Point, Line, PlanarSurface, MultiSurface, SimpleFaultSurface,
-    ComplexFaultSurface, RectangularMesh
-)
-from matplotlib import pyplot
-from mpl_toolkits.basemap import Basemap
 import time
 from threading import Thread
 import os  # Import the os module for file existence check
 import customtkinter
 
-# Your processing function
-def process_eqrm_data_and_find_closest(row, sites_df):
-    # Create PlanarSurface from the row data
-    surf = PlanarSurface(
-        strike=row['strike'], dip=row['dip'],
-        top_left=Point(row['top_left_lon'], row['top_left_lat'], row['top_left_depth']),
-        top_right=Point(row['top_right_lon'], row['top_right_lat'], row['top_right_depth']),
-        bottom_left=Point(row['bottom_left_lon'], row['bottom_left_lat'], row['bottom_left_depth']),
-        bottom_right=Point(row['bottom_right_lon'], row['bottom_right_lat'], row['bottom_right_depth'])
-    )
-    
-    # Define buffer and delta for the grid
-    buf = 1.8
-    delta = 0.001
-
-    # Get bounding box
-    min_lon, max_lon, max_lat, min_lat = surf.get_bounding_box()
-    min_lon -= buf
-    max_lon += buf
-    min_lat -= buf
-    max_lat += buf
-
-    # Create grid of points
-    lons = np.arange(min_lon, max_lon + delta, delta)
-    lats = np.arange(min_lat, max_lat + delta, delta)
-    lons, lats = np.meshgrid(lons, lats)
-    mesh = RectangularMesh(lons=lons, lats=lats, depths=None)
-
-    # Calculate distances
-    r_rup = surf.get_min_distance(mesh)
-    r_jb = surf.get_joyner_boore_distance(mesh)
-    r_x = surf.get_rx_distance(mesh)
-    r_y0 = surf.get_ry0_distance(mesh)
-
-    # Flatten the arrays
-    lats_flattened = np.ravel(mesh.lats)
-    lons_flattened = np.ravel(mesh.lons)
-    r_rup_flattened = np.ravel(r_rup)
-    r_jb_flattened = np.ravel(r_jb)
-    r_x_flattened = np.ravel(r_x)
-    r_y0_flattened = np.ravel(r_y0)
-
-    # Flatten the arrays and combine them into a single array
-    combined_array = np.column_stack((lats_flattened, lons_flattened, r_rup_flattened, r_jb_flattened, r_x_flattened, r_y0_flattened))
-
-    # Write the combined array to a CSV file for each event
-    with open(f"{row['eqe_name']}.csv", 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(['LAT', 'LONG', 'Rrup', 'Rjb', 'Rx', 'Ry0'])
-        for data_row in combined_array:
-            csvwriter.writerow(data_row)
-
-    # Find the closest grid point for each site
-    closest_points = []
-    for _, site in sites_df.iterrows():
-        distances = np.sqrt((lats_flattened - site['Lat'])**2 + (lons_flattened - site['Long'])**2)
-        closest_idx = np.argmin(distances)
-        closest_points.append({
-            'eqe_name': row['eqe_name'],
-            'Strong Motion Site': site['Strong Motion Site'],
-            'SiteLat': site['Lat'],
-            'SiteLong': site['Long'],
-            'Rrup': r_rup_flattened[closest_idx],
-            'Rjb': r_jb_flattened[closest_idx],
-            'Rx': r_x_flattened[closest_idx],
-            'Ry0': r_y0_flattened[closest_idx]
-        })
-
-    return closest_points
-
-# Set up the GUI
-root = customtkinter.CTk()
-root.title("EQRM Data Processor")
-root.geometry("600x400")  # Set window size
-# root.configure(bg='#f0f0f0')  # Set background color
-
-customtkinter.set_appearance_mode("dark")
-
-# Padding
-padx, pady = 10, 5
-
-# Create a label for displaying results or messages
-# Outside of any function, where your widgets are initialized
-result_label = customtkinter.CTkLabel(root, text="")
-result_label.pack(pady=pady)  # Separate the packing to its own line
-
-# # Loading indicator (initially empty)
-loading_label = customtkinter.CTkLabel(root, text="")
-loading_label.pack(pady=pady)
+# Processing core (pandas and OpenQuake are imported when processing starts)
+from rupture_calc import (
+    DEFAULT_TILE_ROWS, LOOKUP_METHODS, OUTPUT_FORMATS, CLOSEST_POINTS_FILE,
+    DEFAULT_CACHE_DIR, RUN_LOG_FILE, load_inputs, run_events,
+    batched_closest_points, write_closest_points, format_stages, RunLog,
+    run_events_resumable
+)
 
 
 def select_file(entry_widget):
@@ -116,18 +25,36 @@ def select_file(entry_widget):
 
 def update_loading_label():
     global loading_label
-    # Update the label with moving ellipses
-    loading_text = "Processing" + "." * ((update_loading_label.count % 4) + 1)
-    loading_label.configure(text=loading_text)
+    if progress_text:
+        # Per-event progress reported by the processing thread
+        loading_label.configure(text=progress_text)
+    else:
+        # Update the label with moving ellipses
+        loading_text = "Processing" + "." * ((update_loading_label.count % 4) + 1)
+        loading_label.configure(text=loading_text)
     update_loading_label.count += 1
     if processing:
         # Schedule this function to be called again after 500ms
         root.after(500, update_loading_label)
 update_loading_label.count = 0
 
+def report_progress(done, total, eqe_name):
+    global progress_text
+    progress_text = f"Processed {done}/{total} events (last: {eqe_name})"
+    if stage_text:
+        progress_text += "\n" + stage_text
+
+def report_stages(record):
+    # Stage timings of the last completed event, also appended to the run log
+    global stage_text
+    stage_text = f"{record['eqe_name']}: {format_stages(record['stages'])}"
+    run_log(record)
+
 def process_files_thread():
-    global processing
+    global processing, progress_text, stage_text, run_log
     processing = True
+    progress_text = ""
+    stage_text = ""
 
     start_time = time.time()  # Start time measurement
 
@@ -136,31 +63,48 @@ def process_files_thread():
         events_file = events_label.get()
 
         # Load data with error checks
-        sites_df = pd.read_csv(sites_file)
-        input_events_df = pd.read_csv(events_file)
-        
-
-        # Check for required columns in sites_df
-        required_sites_columns = ['Lat', 'Long', 'Strong Motion Site']
-        if not all(column in sites_df.columns for column in required_sites_columns):
-            raise ValueError("Sites CSV file does not contain required columns.")
-
-        # Check for required columns in input_events_df
-        required_events_columns = ['strike', 'dip', 'top_left_lon', 'top_left_lat', 'top_left_depth',
-                                   'top_right_lon', 'top_right_lat', 'top_right_depth',
-                                   'bottom_left_lon', 'bottom_left_lat', 'bottom_left_depth',
-                                   'bottom_right_lon', 'bottom_right_lat', 'bottom_right_depth', 'eqe_name']
-        if not all(column in input_events_df.columns for column in required_events_columns):
-            raise ValueError("Events CSV file does not contain required columns.")
+        sites_df, input_events_df = load_inputs(sites_file, events_file)
 
         # Process data
-        closest_data = []
-        for _, row in input_events_df.iterrows():
-            closest_data.extend(process_eqrm_data_and_find_closest(row, sites_df))
-
-        # Convert to DataFrame and save
-        closest_df = pd.DataFrame(closest_data)
-        closest_df.to_csv('output_closest_points.csv', index=False)
+        export_grid = export_grid_var.get()
+        lookup = lookup_var.get()
+        tile_rows = int(tile_rows_entry.get() or 0) or None
+        output_format = output_format_var.get()
+        workers = int(workers_entry.get() or 1)
+        cache_dir = DEFAULT_CACHE_DIR if cache_var.get() else None
+        adaptive = adaptive_var.get()
+        if batched_var.get():
+            # All events at once at the sites, no grids
+            closest_data = batched_closest_points(input_events_df, sites_df,
+                                                  progress=report_progress)
+            stats = {}
+            cache_dir = None
+        else:
+            instrument = instrument_var.get()
+            run_log = RunLog(RUN_LOG_FILE) if instrument else None
+            options = dict(stage_log=report_stages if instrument else None,
+                           instrument=instrument,
+                           export_grid=export_grid, lookup=lookup,
+                           tile_rows=tile_rows,
+                           output_format=output_format,
+                           adaptive=adaptive,
+                           cache_dir=cache_dir)
+            try:
+                if resume_var.get():
+                    # Results are saved as each event completes; failed
+                    # events are reported below and rerun next time
+                    _, stats = run_events_resumable(input_events_df, sites_df, workers=workers,
+                                                    progress=report_progress, **options)
+                else:
+                    closest_data, stats = run_events(input_events_df, sites_df, workers=workers,
+                                                     progress=report_progress, **options)
+            finally:
+                if run_log:
+                    run_log.close()
+
+        if batched_var.get() or not resume_var.get():
+            # Convert to DataFrame and save
+            write_closest_points(closest_data)
 
     except Exception as e:
         result_label.configure(text=f"Error: {e}")
@@ -173,7 +117,12 @@ def process_files_thread():
 
     processing = False  # Stop loading animation
     root.after(0, lambda: loading_label.configure(text=""))  # Clear loading label
-    result_label.configure(text=f"Processing complete! File saved as 'output_closest_points.csv'\nTime elapsed: {elapsed_time:.2f} seconds")
+    cache_text = f"\nDistance cache: {stats['cache_hits']} hits, {stats['cache_misses']} misses" if cache_dir else ""
+    if stats.get('skipped'):
+        cache_text += f"\nSkipped {stats['skipped']} events completed in a previous run"
+    if stats.get('failed'):
+        cache_text += f"\nFailed events (rerun to retry): {', '.join(stats['failed'])}"
+    result_label.configure(text=f"Processing complete! File saved as '{CLOSEST_POINTS_FILE}'\nTime elapsed: {elapsed_time:.2f} seconds{cache_text}")
 
 def process_files():
     global result_label
@@ -196,33 +145,103 @@ def process_files():
     Thread(target=process_files_thread, daemon=True).start()
     update_loading_label()
 
-# Variable for setting text in CTkEntry
-events_text = tk.StringVar()
-sites_text = tk.StringVar()
-
-# Set initial text for CTkEntry widgets
-events_text.set("No file selected")
-sites_text.set("No file selected")
-
-customtkinter.CTkLabel(root, text="Select Site CSV:").pack(pady=pady)
-# sites_label = customtkinter.CTkLabel(root, text="No file selected")
-# sites_label.pack(pady=pady)
-sites_label = customtkinter.CTkEntry(root, state='normal', width=400)
-sites_label.insert(0, "No file selected")
-sites_label.pack(pady=pady)
-customtkinter.CTkButton(root, text="Browse", command=lambda: select_file(sites_label)).pack(pady=pady)
-
-customtkinter.CTkLabel(root, text="Select Events CSV:").pack(pady=pady)
-# events_label = customtkinter.CTkLabel(root, text="No file selected")
-# events_label.pack(pady=pady)
-events_label = customtkinter.CTkEntry(root, state='normal', width=400)
-events_label.insert(0, "No file selected")
-events_label.pack(pady=pady)
-customtkinter.CTkButton(root, text="Browse", command=lambda: select_file(events_label)).pack(pady=pady)
-
-process_button = customtkinter.CTkButton(root, text="Process", command=lambda: process_files()).pack(pady=15)
-
 processing = False  # Flag to indicate if processing is happening
-
-# Run the application
-root.mainloop()
\ No newline at end of file
+progress_text = ""  # Latest progress message from the processing thread
+stage_text = ""  # Stage timings of the last event when instrumented
+run_log = None  # JSON-lines run log of the stage timings
+
+# The GUI is only built when run as a script: worker processes of the process
+# pool re-import this module and must not open a window
+if __name__ == "__main__":
+    # Set up the GUI
+    root = customtkinter.CTk()
+    root.title("EQRM Data Processor")
+    root.geometry("600x400")  # Set window size
+    # root.configure(bg='#f0f0f0')  # Set background color
+
+    customtkinter.set_appearance_mode("dark")
+
+    # Padding
+    padx, pady = 10, 5
+
+    # Create a label for displaying results or messages
+    # Outside of any function, where your widgets are initialized
+    result_label = customtkinter.CTkLabel(root, text="")
+    result_label.pack(pady=pady)  # Separate the packing to its own line
+
+    # # Loading indicator (initially empty)
+    loading_label = customtkinter.CTkLabel(root, text="")
+    loading_label.pack(pady=pady)
+
+    # Variable for setting text in CTkEntry
+    events_text = tk.StringVar()
+    sites_text = tk.StringVar()
+
+    # Set initial text for CTkEntry widgets
+    events_text.set("No file selected")
+    sites_text.set("No file selected")
+
+    customtkinter.CTkLabel(root, text="Select Site CSV:").pack(pady=pady)
+    # sites_label = customtkinter.CTkLabel(root, text="No file selected")
+    # sites_label.pack(pady=pady)
+    sites_label = customtkinter.CTkEntry(root, state='normal', width=400)
+    sites_label.insert(0, "No file selected")
+    sites_label.pack(pady=pady)
+    customtkinter.CTkButton(root, text="Browse", command=lambda: select_file(sites_label)).pack(pady=pady)
+
+    customtkinter.CTkLabel(root, text="Select Events CSV:").pack(pady=pady)
+    # events_label = customtkinter.CTkLabel(root, text="No file selected")
+    # events_label.pack(pady=pady)
+    events_label = customtkinter.CTkEntry(root, state='normal', width=400)
+    events_label.insert(0, "No file selected")
+    events_label.pack(pady=pady)
+    customtkinter.CTkButton(root, text="Browse", command=lambda: select_file(events_label)).pack(pady=pady)
+
+    # Vectorized evaluation of all events at the sites
+    batched_var = tk.BooleanVar(value=False)
+    customtkinter.CTkCheckBox(root, text="Batched engine (sites only)", variable=batched_var).pack(pady=pady)
+
+    # The full-field grid CSVs are only written when explicitly requested
+    export_grid_var = tk.BooleanVar(value=False)
+    customtkinter.CTkCheckBox(root, text="Export full distance grid per event", variable=export_grid_var).pack(pady=pady)
+
+    # Multi-resolution grid, coarser away from the rupture
+    adaptive_var = tk.BooleanVar(value=False)
+    customtkinter.CTkCheckBox(root, text="Adaptive grid resolution", variable=adaptive_var).pack(pady=pady)
+
+    # How sites are mapped onto the exported grid
+    lookup_var = tk.StringVar(value='nearest')
+    customtkinter.CTkOptionMenu(root, values=LOOKUP_METHODS, variable=lookup_var).pack(pady=pady)
+
+    # Grid rows evaluated at once (empty or 0 evaluates the whole grid in one go)
+    customtkinter.CTkLabel(root, text="Grid rows per tile:").pack(pady=pady)
+    tile_rows_entry = customtkinter.CTkEntry(root, width=100)
+    tile_rows_entry.insert(0, str(DEFAULT_TILE_ROWS))
+    tile_rows_entry.pack(pady=pady)
+
+    # File format of the exported grid
+    output_format_var = tk.StringVar(value='csv')
+    customtkinter.CTkOptionMenu(root, values=OUTPUT_FORMATS, variable=output_format_var).pack(pady=pady)
+
+    # Reuse distance grids of ruptures with identical geometry across runs
+    cache_var = tk.BooleanVar(value=False)
+    customtkinter.CTkCheckBox(root, text="Cache distance grids", variable=cache_var).pack(pady=pady)
+
+    # Save results as events complete and skip completed events on rerun
+    resume_var = tk.BooleanVar(value=False)
+    customtkinter.CTkCheckBox(root, text="Resume from checkpoint", variable=resume_var).pack(pady=pady)
+
+    # Per-stage time and memory of each event, shown live and logged
+    instrument_var = tk.BooleanVar(value=False)
+    customtkinter.CTkCheckBox(root, text=f"Log stage timings ({RUN_LOG_FILE})", variable=instrument_var).pack(pady=pady)
+
+    # Number of events processed in parallel (1 runs them serially)
+    customtkinter.CTkLabel(root, text="Worker processes:").pack(pady=pady)
+    workers_entry = customtkinter.CTkEntry(root, width=100)
+    workers_entry.insert(0, str(os.cpu_count() or 1))
+    workers_entry.pack(pady=pady)
+
+    process_button = customtkinter.CTkButton(root, text="Process", command=lambda: process_files()).pack(pady=15)
+
+    # Run the application
+    root.mainloop()
@@ -0,0 +1,1615 @@
+"""
+Core of the EQRM rupture distance calculator: evaluates Rrup, Rjb, Rx and
+Ry0 from planar ruptures to strong-motion sites. Rows of the events file
+sharing an eqe_name are evaluated as the segments of one multi-segment
+rupture. Drives both the
+rupture-calc-app.py GUI and the command line batch runner:
+
+    python rupture_calc.py sites.csv events.csv -o output --delta 0.001 --buffer 1.8
+
+pandas and OpenQuake are only imported once processing starts.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import closing, contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# Mean earth radius (km), as used by openquake.hazardlib.geo.geodetic
+EARTH_RADIUS = 6371.0
+
+# Site lookup methods available for the dense grid mode
+LOOKUP_METHODS = ['nearest', 'bilinear', 'kdtree']
+
+# Default buffer around the rupture bounding box and grid spacing (degrees)
+DEFAULT_BUFFER = 1.8
+DEFAULT_DELTA = 0.001
+
+# Default number of latitude rows evaluated at once in the dense grid mode
+DEFAULT_TILE_ROWS = 200
+
+# Default location and size limit (bytes) of the distance field cache
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rupture_calc')
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3
+
+# Great-circle length (km) of one degree of arc on the EARTH_RADIUS sphere
+KM_PER_DEGREE = np.pi * EARTH_RADIUS / 180.
+
+# Default interpolation error bound (km) of the adaptive grid
+DEFAULT_TOLERANCE = 0.05
+
+# Number of events evaluated together by the batched engine, and the largest
+# difference (km) from the PlanarSurface methods its results are checked to
+DEFAULT_EVENT_BLOCK = 256
+BATCH_TOLERANCE = 1e-6
+
+# Name of the merged closest-point output written in the output directory
+CLOSEST_POINTS_FILE = 'output_closest_points.csv'
+
+# JSON-lines log of the per-event stage timings, next to CLOSEST_POINTS_FILE
+RUN_LOG_FILE = 'output_run_log.jsonl'
+
+# Manifest of the completed and failed events of a resumable run
+CHECKPOINT_FILE = 'output_checkpoint.json'
+
+# Required columns of the input files
+REQUIRED_SITES_COLUMNS = ['Lat', 'Long', 'Strong Motion Site']
+REQUIRED_EVENTS_COLUMNS = ['strike', 'dip', 'top_left_lon', 'top_left_lat', 'top_left_depth',
+                           'top_right_lon', 'top_right_lat', 'top_right_depth',
+                           'bottom_left_lon', 'bottom_left_lat', 'bottom_left_depth',
+                           'bottom_right_lon', 'bottom_right_lat', 'bottom_right_depth', 'eqe_name']
+
+# Distance metrics stored for each grid point, in output order
+GRID_COLUMNS = ['Rrup', 'Rjb', 'Rx', 'Ry0']
+
+
+# Resident set size high-water mark of the process in bytes (None where the
+# resource module is not available, e.g. on Windows)
+def _max_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Per-stage instrumentation of one event: wall time, number of calls and the
+# process RSS high-water mark at the end of the stage. With trace_memory the
+# peak memory traced by tracemalloc (numpy arrays included) above the level
+# at the start of the stage is recorded too; this is exact per stage but
+# slows down allocation-heavy stages such as CSV writing several times.
+# Repeated stages, e.g. once per grid tile, accumulate their time and keep
+# their largest peak. Stages must not nest
+class StageRecorder(object):
+
+    def __init__(self, trace_memory=False):
+        self.stages = {}
+        self.trace_memory = trace_memory
+        self._started = False
+        if trace_memory:
+            # Load the lazily imported dependencies first: importing them
+            # under tracemalloc is slow and would be charged to a stage
+            import pandas
+            import openquake.hazardlib.geo
+            self._started = not tracemalloc.is_tracing()
+            if self._started:
+                tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            record = self.stages.setdefault(
+                name, {'seconds': 0., 'calls': 0, 'max_rss_bytes': None})
+            record['seconds'] += seconds
+            record['calls'] += 1
+            record['max_rss_bytes'] = _max_rss()
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] - start_memory
+                record['peak_bytes'] = max(record.get('peak_bytes', 0), peak)
+
+    def result(self):
+        return self.stages
+
+    def close(self):
+        # Stop tracing if this recorder started it
+        if self._started and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+# Stand-in used when instrumentation is off: every stage is the same no-op
+# context manager and nothing is measured
+class NullRecorder(object):
+    _null_stage = nullcontext()
+
+    def stage(self, name):
+        return self._null_stage
+
+    def result(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+NULL_RECORDER = NullRecorder()
+
+
+# One-line summary of the slowest stages of an event, for progress displays
+def format_stages(stages, count=4):
+    slowest = sorted(stages.items(), key=lambda item: -item[1]['seconds'])
+    text = ', '.join('%s %.2fs' % (name, record['seconds'])
+                     for name, record in slowest[:count])
+    peaks = [record['peak_bytes'] for record in stages.values()
+             if 'peak_bytes' in record]
+    if peaks:
+        return text + ' (peak %.0f MB traced)' % (max(peaks) / 1024 ** 2)
+    rss = [record['max_rss_bytes'] for record in stages.values()
+           if record['max_rss_bytes'] is not None]
+    if rss:
+        return text + ' (max RSS %.0f MB)' % (max(rss) / 1024 ** 2)
+    return text
+
+
+# Appends the stage record of each event to the JSON-lines run log
+class RunLog(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fid = open(filename, 'w')
+
+    def __call__(self, record):
+        self.fid.write(json.dumps(record) + '\n')
+        self.fid.flush()
+
+    def close(self):
+        self.fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Maps site coordinates onto a regular lon/lat grid (as built by np.meshgrid of
+# evenly spaced np.arange axes) with index arithmetic, so the cost of a lookup
+# depends on the number of sites only and not on the number of grid points
+class RegularGridIndex(object):
+
+    def __init__(self, lon0, lat0, delta, nlon, nlat):
+        self.lon0 = lon0
+        self.lat0 = lat0
+        self.delta = delta
+        self.nlon = nlon
+        self.nlat = nlat
+
+    def _fractional_indices(self, site_lons, site_lats):
+        cols = (np.asarray(site_lons, dtype=float) - self.lon0) / self.delta
+        rows = (np.asarray(site_lats, dtype=float) - self.lat0) / self.delta
+        return (np.clip(rows, 0, self.nlat - 1),
+                np.clip(cols, 0, self.nlon - 1))
+
+    def nearest(self, site_lons, site_lats):
+        # Rounding each axis independently gives the node with the smallest
+        # Euclidean lat/lon distance, i.e. the same node as a full argmin scan
+        rows, cols = self._fractional_indices(site_lons, site_lats)
+        return np.rint(rows).astype(int), np.rint(cols).astype(int)
+
+    def bilinear_weights(self, site_lons, site_lats):
+        # Lower-left node of the enclosing cell and the weights of its four
+        # corners, ordered (r0, c0), (r0, c1), (r1, c0), (r1, c1)
+        rows, cols = self._fractional_indices(site_lons, site_lats)
+        row0 = np.floor(rows).astype(int)
+        col0 = np.floor(cols).astype(int)
+        frow = rows - row0
+        fcol = cols - col0
+        weights = np.column_stack(((1. - frow) * (1. - fcol),
+                                   (1. - frow) * fcol,
+                                   frow * (1. - fcol),
+                                   frow * fcol))
+        return row0, col0, weights
+
+    def sample(self, values, site_lons, site_lats, method='nearest'):
+        # values is a (nlat, nlon) array of one distance metric on the grid
+        if method == 'nearest':
+            rows, cols = self.nearest(site_lons, site_lats)
+            return values[rows, cols]
+        elif method == 'bilinear':
+            row0, col0, weights = self.bilinear_weights(site_lons, site_lats)
+            row1 = np.minimum(row0 + 1, self.nlat - 1)
+            col1 = np.minimum(col0 + 1, self.nlon - 1)
+            return (weights[:, 0] * values[row0, col0] +
+                    weights[:, 1] * values[row0, col1] +
+                    weights[:, 2] * values[row1, col0] +
+                    weights[:, 3] * values[row1, col1])
+        raise ValueError("Unknown grid lookup method %s" % method)
+
+
+# Unit vectors on the sphere: the chord length between two of them is a
+# monotonic function of their great-circle (haversine) distance
+def _unit_vectors(lons, lats):
+    lons = np.radians(np.ravel(lons))
+    lats = np.radians(np.ravel(lats))
+    cos_lats = np.cos(lats)
+    return np.column_stack((cos_lats * np.cos(lons),
+                            cos_lats * np.sin(lons),
+                            np.sin(lats)))
+
+
+# Nearest-node lookup for meshes that are not regular lon/lat grids, using
+# great-circle rather than Euclidean lat/lon distances. Needs scipy
+class HaversineKDTree(object):
+
+    def __init__(self, lons, lats):
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(_unit_vectors(lons, lats))
+
+    def nearest(self, site_lons, site_lats):
+        # Returns the haversine distance (km) to, and flat index of, the
+        # closest mesh node for each site
+        chords, idx = self.tree.query(_unit_vectors(site_lons, site_lats))
+        distances = 2. * EARTH_RADIUS * np.arcsin(np.clip(chords / 2., 0., 1.))
+        return distances, idx
+
+
+# Streaming nearest-site reduction: collects the grid values at the sites tile
+# by tile, as the tiles are produced by iter_grid_tiles, so the full grid never
+# has to be held in memory
+class SiteGridReducer(object):
+
+    def __init__(self, index, site_lons, site_lats, method='nearest'):
+        if method not in LOOKUP_METHODS:
+            raise ValueError("Unknown grid lookup method %s" % method)
+        self.method = method
+        self.site_lons = np.asarray(site_lons, dtype=float)
+        self.site_lats = np.asarray(site_lats, dtype=float)
+        self.values = np.full((4, self.site_lons.size), np.nan)
+        # Bilinear lookups need the row above the last row owned by a tile
+        self.overlap = 1 if method == 'bilinear' else 0
+        if method == 'nearest':
+            self.rows, self.cols = index.nearest(self.site_lons, self.site_lats)
+        elif method == 'bilinear':
+            self.rows, self.cols, self.weights = index.bilinear_weights(
+                self.site_lons, self.site_lats)
+            self.rows1 = np.minimum(self.rows + 1, index.nlat - 1)
+            self.cols1 = np.minimum(self.cols + 1, index.nlon - 1)
+        else:
+            self.best = np.full(self.site_lons.size, np.inf)
+
+    def update(self, row_start, nrows, mesh, fields):
+        if self.method == 'kdtree':
+            # Keep, for each site, the closest node seen over all tiles so far
+            tree = HaversineKDTree(mesh.lons[:nrows], mesh.lats[:nrows])
+            distances, idx = tree.nearest(self.site_lons, self.site_lats)
+            closer = distances < self.best
+            self.best[closer] = distances[closer]
+            for i, field in enumerate(fields):
+                self.values[i, closer] = np.ravel(field[:nrows])[idx[closer]]
+            return
+        # Sites whose (lower) row is owned by this tile
+        in_tile = (self.rows >= row_start) & (self.rows < row_start + nrows)
+        if not np.any(in_tile):
+            return
+        rows = self.rows[in_tile] - row_start
+        cols = self.cols[in_tile]
+        for i, field in enumerate(fields):
+            if self.method == 'nearest':
+                self.values[i, in_tile] = field[rows, cols]
+            else:
+                rows1 = self.rows1[in_tile] - row_start
+                cols1 = self.cols1[in_tile]
+                weights = self.weights[in_tile]
+                self.values[i, in_tile] = (weights[:, 0] * field[rows, cols] +
+                                           weights[:, 1] * field[rows, cols1] +
+                                           weights[:, 2] * field[rows1, cols] +
+                                           weights[:, 3] * field[rows1, cols1])
+
+    def result(self):
+        # Rrup, Rjb, Rx and Ry0 at the sites
+        return tuple(self.values)
+
+
+# Evaluates the four distance metrics over the grid one block of latitude rows
+# at a time. Each tile owns nrows rows and carries up to `overlap` extra rows
+# beyond them; tile_rows=None evaluates the whole grid as a single tile.
+# When a cached (4, nlat, nlon) array is given the tiles are read from it
+# instead of being computed
+def iter_grid_tiles(surf, lon_axis, lat_axis, tile_rows=DEFAULT_TILE_ROWS,
+                    overlap=0, cached=None, recorder=NULL_RECORDER):
+    nlat = lat_axis.size
+    if not tile_rows:
+        tile_rows = nlat
+    from openquake.hazardlib.geo import RectangularMesh
+    for row_start in range(0, nlat, tile_rows):
+        nrows = min(tile_rows, nlat - row_start)
+        row_stop = min(row_start + nrows + overlap, nlat)
+        with recorder.stage('mesh'):
+            lons, lats = np.meshgrid(lon_axis, lat_axis[row_start:row_stop])
+            mesh = RectangularMesh(lons=lons, lats=lats, depths=None)
+        if cached is not None:
+            with recorder.stage('cache_read'):
+                fields = tuple(np.asarray(values[row_start:row_stop])
+                               for values in cached)
+        else:
+            fields = surface_distances(surf, mesh, recorder)
+        yield row_start, nrows, mesh, fields
+
+
+# Per-event grid writers. All of them receive the grid tile by tile (see
+# iter_grid_tiles) so the whole grid is never held in memory. The binary
+# formats do not store LAT/LONG: they are implied by the JSON sidecar
+# ({eqe_name}.json), LAT = lat0 + row * delta and LONG = lon0 + col * delta.
+# The sidecar marks a complete grid: it is only written by close(), when the
+# with block exits normally; on an error abort() removes the partial output
+class GridWriter(object):
+    extension = None
+
+    def __init__(self, basename, index):
+        self.basename = basename
+        self.index = index
+        self.filename = basename + self.extension
+
+    def write_tile(self, row_start, nrows, mesh, fields):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+    # Removes the data file and sidecar, e.g. of an earlier run
+    def remove_outputs(self):
+        for path in (self.filename, self.basename + '.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def grid_metadata(self):
+        return {
+            'data_file': os.path.basename(self.filename),
+            'columns': GRID_COLUMNS,
+            'lon0': float(self.index.lon0),
+            'lat0': float(self.index.lat0),
+            'delta': float(self.index.delta),
+            'nlon': int(self.index.nlon),
+            'nlat': int(self.index.nlat)
+        }
+
+    def write_sidecar(self, **kwargs):
+        metadata = self.grid_metadata()
+        metadata.update(kwargs)
+        with open(self.basename + '.json', 'w') as fid:
+            json.dump(metadata, fid, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Plain text LAT, LONG, Rrup, Rjb, Rx, Ry0 rows, written with pandas' bulk
+# CSV writer one tile at a time
+class CsvGridWriter(GridWriter):
+    extension = '.csv'
+
+    def __init__(self, basename, index):
+        super().__init__(basename, index)
+        self.fid = open(self.filename, 'w', newline='')
+        self.fid.write(','.join(['LAT', 'LONG'] + GRID_COLUMNS) + '\n')
+
+    def write_tile(self, row_start, nrows, mesh, fields):
+        combined_array = np.column_stack([
+            np.ravel(values[:nrows])
+            for values in (mesh.lats, mesh.lons) + tuple(fields)])
+        import pandas as pd
+        pd.DataFrame(combined_array).to_csv(self.fid, header=False,
+                                            index=False)
+
+    def close(self):
+        self.fid.close()
+
+    def abort(self):
+        self.fid.close()
+        self.remove_outputs()
+
+
+# Raw float32 array of shape (4, nlat, nlon), readable with
+# np.memmap(data_file, dtype='float32', mode='r', shape=shape)
+class MemmapGridWriter(GridWriter):
+    extension = '.f32'
+
+    def __init__(self, basename, index):
+        super().__init__(basename, index)
+        self.shape = (len(GRID_COLUMNS), index.nlat, index.nlon)
+        self.data = np.memmap(self.filename, dtype=np.float32, mode='w+',
+                              shape=self.shape)
+
+    def write_tile(self, row_start, nrows, mesh, fields):
+        for i, values in enumerate(fields):
+            self.data[i, row_start:row_start + nrows, :] = values[:nrows]
+
+    def close(self):
+        self.data.flush()
+        del self.data
+        self.write_sidecar(format='memmap', dtype='float32',
+                           shape=list(self.shape), order='C')
+
+    def abort(self):
+        del self.data
+        self.remove_outputs()
+
+
+# Compressed NPZ with one (nlat, nlon) array per metric. The tiles are staged
+# in a temporary memory-mapped .npy file and compressed on close
+class NpzGridWriter(GridWriter):
+    extension = '.npz'
+
+    def __init__(self, basename, index):
+        super().__init__(basename, index)
+        self.staging_file = basename + '.staging.npy'
+        self.data = np.lib.format.open_memmap(
+            self.staging_file, mode='w+', dtype=np.float64,
+            shape=(len(GRID_COLUMNS), index.nlat, index.nlon))
+
+    def write_tile(self, row_start, nrows, mesh, fields):
+        for i, values in enumerate(fields):
+            self.data[i, row_start:row_start + nrows, :] = values[:nrows]
+
+    def close(self):
+        grid = self.grid_metadata()
+        np.savez_compressed(
+            self.filename,
+            lon0=grid['lon0'], lat0=grid['lat0'], delta=grid['delta'],
+            **dict(zip(GRID_COLUMNS, self.data)))
+        del self.data
+        os.remove(self.staging_file)
+        self.write_sidecar(format='npz')
+
+    def abort(self):
+        del self.data
+        os.remove(self.staging_file)
+        self.remove_outputs()
+
+
+# Parquet file with the four metric columns in row-major grid order, one row
+# group per tile. Needs pyarrow
+class ParquetGridWriter(GridWriter):
+    extension = '.parquet'
+
+    def __init__(self, basename, index):
+        super().__init__(basename, index)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        schema = pa.schema([(column, pa.float64()) for column in GRID_COLUMNS],
+                           metadata={'grid': json.dumps(self.grid_metadata())})
+        self.writer = pq.ParquetWriter(self.filename, schema)
+
+    def write_tile(self, row_start, nrows, mesh, fields):
+        table = self.pa.Table.from_arrays(
+            [self.pa.array(np.ravel(values[:nrows])) for values in fields],
+            schema=self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+        self.write_sidecar(format='parquet')
+
+    def abort(self):
+        self.writer.close()
+        self.remove_outputs()
+
+
+# Grid used for the site lookup only, nothing written
+class NullGridWriter(GridWriter):
+    extension = ''
+
+    def write_tile(self, row_start, nrows, mesh, fields):
+        pass
+
+
+GRID_WRITERS = {
+    'csv': CsvGridWriter,
+    'npz': NpzGridWriter,
+    'parquet': ParquetGridWriter,
+    'memmap': MemmapGridWriter,
+    'none': NullGridWriter
+}
+
+# Output formats available for the per-event grid
+OUTPUT_FORMATS = list(GRID_WRITERS)
+
+# Signed distances (km) to the two great-circle arcs perpendicular to strike
+# through the ends of the top edge, from which Ry0 is derived as in OpenQuake
+def _ry0_arcs(surf, lons, lats):
+    from openquake.hazardlib.geo import geodetic
+    azimuth = (surf.get_strike() + 90.) % 360
+    return tuple(
+        geodetic.distance_to_arc(surf.corner_lons[i], surf.corner_lats[i],
+                                 azimuth, lons, lats)
+        for i in (0, 1))
+
+
+# Ry0 is zero between the two arcs, else the distance to the closer one
+def _ry0_from_arcs(dst1, dst2):
+    return np.where(np.sign(dst1) == np.sign(dst2),
+                    np.fmin(np.abs(dst1), np.abs(dst2)), 0.)
+
+
+# Nested multi-resolution grid around the rupture. Level 0 covers the surface
+# projection at the configured delta, each following level doubles the spacing
+# and the outermost one covers the full buffered bounding box.
+#
+# Rrup and Rjb are distances to a convex set, whose second derivatives are
+# bounded by 1 / distance, so bilinear interpolation in a cell of side h km at
+# a distance of at least d km is in error by at most h**2 / (4 * d). A level of
+# spacing h is therefore only used at points farther than
+# h**2 / (4 * tolerance) + sqrt(2) * h km from the surface projection (the
+# second term keeping the whole cell out). Rx and the two arcs Ry0 is derived
+# from are interpolated instead of Ry0 itself, whose kinks extend to infinity.
+# They are linear only up to the Earth's curvature, which the tolerance check
+# leaves out, so for Rx and Ry0 (which changes by no more than the arcs) the
+# bound is approximate: the neglected error is of order h**2 * d / R**2 at d
+# km from the arc, R the Earth's radius. Within level 0 the values are those
+# of the uniform grid at delta
+class AdaptiveDistanceGrid(object):
+
+    def __init__(self, surf, buf=DEFAULT_BUFFER, delta=DEFAULT_DELTA,
+                 tolerance=DEFAULT_TOLERANCE):
+        from openquake.hazardlib.geo import RectangularMesh
+        self.tolerance = tolerance
+        west, east, north, south = surf.get_bounding_box()
+        # (index, Rrup, Rjb, Rx, dst1, dst2) per level, finest first
+        self.levels = []
+        step = delta
+        while True:
+            # Everything beyond reach km of the projection is left to the
+            # next, twice coarser level
+            reach = self.min_distance(2. * step)
+            dlat = min(reach / KM_PER_DEGREE, buf)
+            max_lat = min(max(abs(south - dlat), abs(north + dlat)), 89.)
+            dlon = min(reach / (KM_PER_DEGREE * np.cos(np.radians(max_lat))),
+                       buf)
+            lon_axis = np.arange(west - dlon, east + dlon + step, step)
+            lat_axis = np.arange(south - dlat, north + dlat + step, step)
+            lons, lats = np.meshgrid(lon_axis, lat_axis)
+            mesh = RectangularMesh(lons=lons, lats=lats, depths=None)
+            index = RegularGridIndex(lon_axis[0], lat_axis[0], step,
+                                     lon_axis.size, lat_axis.size)
+            fields = tuple(np.reshape(values, lons.shape) for values in (
+                surf.get_min_distance(mesh),
+                surf.get_joyner_boore_distance(mesh),
+                surf.get_rx_distance(mesh)) + _ry0_arcs(surf, lons, lats))
+            self.levels.append((index,) + fields)
+            if dlat >= buf and dlon >= buf:
+                break
+            step *= 2.
+
+    def min_distance(self, step):
+        # Distance (km) from the rupture beyond which a level of the given
+        # spacing (degrees) meets the tolerance
+        h = step * KM_PER_DEGREE
+        return h ** 2 / (4. * self.tolerance) + np.sqrt(2.) * h
+
+    @property
+    def size(self):
+        return sum(index.nlon * index.nlat for index, *_ in self.levels)
+
+    def _contains(self, index, site_lons, site_lats):
+        lon1 = index.lon0 + (index.nlon - 1) * index.delta
+        lat1 = index.lat0 + (index.nlat - 1) * index.delta
+        return ((site_lons >= index.lon0) & (site_lons <= lon1) &
+                (site_lats >= index.lat0) & (site_lats <= lat1))
+
+    def sample(self, site_lons, site_lats):
+        # Rrup, Rjb, Rx and Ry0 at the sites, each site interpolated on the
+        # finest level containing it (sites outside the grid are clamped to
+        # its edge as with the uniform grid)
+        site_lons = np.asarray(site_lons, dtype=float)
+        site_lats = np.asarray(site_lats, dtype=float)
+        values = np.full((5, site_lons.size), np.nan)
+        for i, (index, *fields) in reversed(list(enumerate(self.levels))):
+            inside = np.ones(site_lons.size, dtype=bool) if i == len(
+                self.levels) - 1 else self._contains(index, site_lons, site_lats)
+            if not np.any(inside):
+                continue
+            for j, field in enumerate(fields):
+                values[j, inside] = index.sample(field, site_lons[inside],
+                                                 site_lats[inside], 'bilinear')
+        r_rup, r_jb, r_x, dst1, dst2 = values
+        return r_rup, r_jb, r_x, _ry0_from_arcs(dst1, dst2)
+
+    def write(self, basename, output_format='csv'):
+        # One grid file (with its sidecar) per level, {basename}_L{level},
+        # and a {basename}.json manifest listing the levels finest first
+        from openquake.hazardlib.geo import RectangularMesh
+        # The manifest of an earlier run would mark partial levels complete
+        try:
+            os.remove(basename + '.json')
+        except FileNotFoundError:
+            pass
+        levels = []
+        for i, (index, r_rup, r_jb, r_x, dst1, dst2) in enumerate(self.levels):
+            lons, lats = np.meshgrid(
+                index.lon0 + np.arange(index.nlon) * index.delta,
+                index.lat0 + np.arange(index.nlat) * index.delta)
+            mesh = RectangularMesh(lons=lons, lats=lats, depths=None)
+            fields = (r_rup, r_jb, r_x, _ry0_from_arcs(dst1, dst2))
+            with GRID_WRITERS[output_format]('%s_L%d' % (basename, i),
+                                             index) as writer:
+                writer.write_tile(0, index.nlat, mesh, fields)
+                levels.append(writer.grid_metadata())
+        if output_format != 'none':
+            with open(basename + '.json', 'w') as fid:
+                json.dump({'format': 'adaptive', 'grid_format': output_format,
+                           'tolerance': self.tolerance, 'levels': levels},
+                          fid, indent=2)
+
+
+# Geometry columns that fully define the distance field of a rupture
+GEOMETRY_COLUMNS = [column for column in REQUIRED_EVENTS_COLUMNS
+                    if column != 'eqe_name']
+
+
+# Content hash of a rupture's geometry (all its segments) and of the grid
+# definition
+def distance_cache_key(row, buf, delta):
+    values = [float(segment[column]) for segment in event_segments(row)
+              for column in GEOMETRY_COLUMNS]
+    values += [float(buf), float(delta)]
+    return hashlib.sha256(json.dumps(values).encode()).hexdigest()
+
+
+# On-disk cache of the four distance arrays of each rupture grid, one
+# (4, nlat, nlon) .npy file per cache key. Entries are read back memory-mapped
+# and evicted least recently used first once the cache exceeds max_bytes
+class DistanceCache(object):
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def load(self, key, index):
+        path = self._path(key)
+        try:
+            data = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if data.shape != (len(GRID_COLUMNS), index.nlat, index.nlon):
+            self.misses += 1
+            return None
+        # Mark as recently used
+        os.utime(path)
+        self.hits += 1
+        return data
+
+    def writer(self, key, index):
+        return CacheEntryWriter(self, key, index)
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Already evicted by another worker
+                pass
+            total -= size
+
+
+# Stores the tiles of a freshly computed grid in the cache. The entry is
+# staged under a temporary name and only renamed into place once complete,
+# so concurrent workers never read a partial entry
+class CacheEntryWriter(GridWriter):
+    extension = '.npy'
+
+    def __init__(self, cache, key, index):
+        super().__init__(cache._path(key)[:-len(self.extension)], index)
+        self.cache = cache
+        self.staging_file = '%s.%d.tmp' % (self.filename, os.getpid())
+        shape = (len(GRID_COLUMNS), index.nlat, index.nlon)
+        self.enabled = 8 * np.prod(shape) <= cache.max_bytes
+        if self.enabled:
+            self.data = np.lib.format.open_memmap(
+                self.staging_file, mode='w+', dtype=np.float64, shape=shape)
+
+    def write_tile(self, row_start, nrows, mesh, fields):
+        if self.enabled:
+            for i, values in enumerate(fields):
+                self.data[i, row_start:row_start + nrows, :] = values[:nrows]
+
+    def close(self):
+        if self.enabled:
+            self.data.flush()
+            del self.data
+            os.replace(self.staging_file, self.filename)
+            self.cache.evict(keep=self.filename)
+
+    def abort(self):
+        # The entry itself may have been written by another worker
+        if self.enabled:
+            del self.data
+            os.remove(self.staging_file)
+
+
+# Build the planar rupture surface described by one row of the events file
+def build_planar_surface(row):
+    from openquake.hazardlib.geo import Point, PlanarSurface
+    return PlanarSurface(
+        strike=row['strike'], dip=row['dip'],
+        top_left=Point(row['top_left_lon'], row['top_left_lat'], row['top_left_depth']),
+        top_right=Point(row['top_right_lon'], row['top_right_lat'], row['top_right_depth']),
+        bottom_left=Point(row['bottom_left_lon'], row['bottom_left_lat'], row['bottom_left_depth']),
+        bottom_right=Point(row['bottom_right_lon'], row['bottom_right_lat'], row['bottom_right_depth'])
+    )
+
+# Rows of the events file sharing an eqe_name are the planar segments of one
+# multi-segment rupture, in file order (and traced consistently along strike
+# for the Rx/Ry0 GC2 coordinates). An event is passed around as its row, or
+# as a DataFrame of its segment rows when it has several
+def iter_event_rows(input_events_df):
+    for _, group in input_events_df.groupby('eqe_name', sort=False):
+        yield group.iloc[0] if len(group) == 1 else group
+
+def event_segments(row):
+    if hasattr(row, 'iterrows'):
+        return [segment for _, segment in row.iterrows()]
+    return [row]
+
+def event_name(row):
+    return event_segments(row)[0]['eqe_name']
+
+# Build the rupture surface of an event: a PlanarSurface, or a MultiSurface of
+# the planar segments of a multi-segment rupture
+def build_surface(row):
+    segments = event_segments(row)
+    if len(segments) == 1:
+        return build_planar_surface(segments[0])
+    from openquake.hazardlib.geo import MultiSurface
+    return MultiSurface([build_planar_surface(segment) for segment in segments])
+
+# Lower bound (km) of the great-circle distance from the points to a lon/lat
+# box: the larger of the distance to the band of latitudes and the distance
+# to the great circle of the nearer bounding meridian
+def _box_distance_bound(west, east, north, south, lons, lats):
+    lat_gap = np.maximum(np.maximum(south - lats, lats - north), 0.)
+    lon_gap = np.maximum(np.maximum(west - lons, lons - east), 0.)
+    lon_gap = np.radians(np.minimum(lon_gap, 90.))
+    return np.maximum(
+        lat_gap * KM_PER_DEGREE,
+        EARTH_RADIUS * np.arcsin(np.sin(lon_gap) * np.cos(np.radians(lats))))
+
+# Rrup and Rjb of a multi-segment surface, the minimum over the segments,
+# evaluating each segment only at the points where it can be the closest one.
+# The distance to a segment's bounding box bounds its Rjb, and hence its Rrup,
+# from below (converted to a chord, as OpenQuake measures Rjb to the corners
+# and Rrup in Cartesian coordinates, and allowing for depth below a curved
+# surface). Each point is first evaluated against the segment with the
+# nearest box; the other segments are then only evaluated at the points where
+# their lower bound is below the distances found so far, so the cost follows
+# the area near each segment rather than segments x points
+def _segment_min_distances(surf, lons, lats):
+    from openquake.hazardlib.geo import Mesh
+    lons = np.ravel(lons)
+    lats = np.ravel(lats)
+    lower_jb = []
+    lower_rup = []
+    for segment in surf.surfaces:
+        west, east, north, south = segment.get_bounding_box()
+        arc = _box_distance_bound(west, east, north, south, lons, lats)
+        chord = 2. * EARTH_RADIUS * np.sin(
+            np.minimum(arc / (2. * EARTH_RADIUS), np.pi / 2.))
+        deepest = np.max(segment.corner_depths)
+        lower_jb.append(chord)
+        lower_rup.append(chord * np.sqrt(max(0., 1. - deepest / EARTH_RADIUS)))
+    first = np.argmin(lower_jb, axis=0)
+
+    r_rup = np.full(lons.size, np.inf)
+    r_jb = np.full(lons.size, np.inf)
+
+    def evaluate(segment, points):
+        mesh = Mesh(lons=lons[points], lats=lats[points], depths=None)
+        r_rup[points] = np.fmin(r_rup[points],
+                                np.ravel(segment.get_min_distance(mesh)))
+        r_jb[points] = np.fmin(
+            r_jb[points], np.ravel(segment.get_joyner_boore_distance(mesh)))
+
+    for i, segment in enumerate(surf.surfaces):
+        points = np.flatnonzero(first == i)
+        if points.size:
+            evaluate(segment, points)
+    for i, segment in enumerate(surf.surfaces):
+        points = np.flatnonzero((first != i) & ((lower_rup[i] < r_rup) |
+                                                (lower_jb[i] < r_jb)))
+        if points.size:
+            evaluate(segment, points)
+    return r_rup, r_jb
+
+# Rrup, Rjb, Rx and Ry0 of a surface at the points of a mesh, each shaped like
+# the mesh (some OpenQuake versions return the distances flattened)
+def surface_distances(surf, mesh, recorder=NULL_RECORDER):
+    shape = mesh.lons.shape
+    if hasattr(surf, 'surfaces'):
+        from openquake.hazardlib.geo import Mesh
+        with recorder.stage('Rrup+Rjb'):
+            r_rup, r_jb = _segment_min_distances(surf, mesh.lons, mesh.lats)
+        # The GC2 coordinates of a MultiSurface need a flat mesh
+        mesh = Mesh(lons=np.ravel(mesh.lons), lats=np.ravel(mesh.lats),
+                    depths=None)
+    else:
+        with recorder.stage('Rrup'):
+            r_rup = surf.get_min_distance(mesh)
+        with recorder.stage('Rjb'):
+            r_jb = surf.get_joyner_boore_distance(mesh)
+    with recorder.stage('Rx'):
+        r_x = surf.get_rx_distance(mesh)
+    with recorder.stage('Ry0'):
+        r_y0 = surf.get_ry0_distance(mesh)
+    return tuple(np.reshape(values, shape)
+                 for values in (r_rup, r_jb, r_x, r_y0))
+
+# Evaluate Rrup, Rjb, Rx and Ry0 exactly at the strong-motion site coordinates
+def get_site_distances(surf, sites_df, recorder=NULL_RECORDER):
+    from openquake.hazardlib.geo import Mesh
+    mesh = Mesh(lons=sites_df['Long'].to_numpy(dtype=float),
+                lats=sites_df['Lat'].to_numpy(dtype=float),
+                depths=None)
+    return surface_distances(surf, mesh, recorder)
+
+# One output record per site, in the column order of output_closest_points.csv
+def closest_point_records(row, sites_df, r_rup, r_jb, r_x, r_y0):
+    closest_points = []
+    for i, (site_name, site_lat, site_lon) in enumerate(zip(
+            sites_df['Strong Motion Site'], sites_df['Lat'], sites_df['Long'])):
+        closest_points.append({
+            'eqe_name': event_name(row),
+            'Strong Motion Site': site_name,
+            'SiteLat': site_lat,
+            'SiteLong': site_lon,
+            'Rrup': r_rup[i],
+            'Rjb': r_jb[i],
+            'Rx': r_x[i],
+            'Ry0': r_y0[i]
+        })
+    return closest_points
+
+# Your processing function
+# By default the distances are evaluated exactly at the sites only; the dense
+# grid (buf degrees around the rupture, delta degrees spacing) and its
+# per-event output file in output_dir are built only when export_grid is
+# requested. lookup selects how sites are mapped onto the grid (see
+# LOOKUP_METHODS), tile_rows how many grid rows are evaluated and written at
+# once and output_format the file format of the grid (see OUTPUT_FORMATS).
+# With a DistanceCache the grid is read from the cache when the same rupture
+# geometry, buf and delta have been computed before. adaptive replaces the
+# uniform grid with an AdaptiveDistanceGrid interpolated within tolerance km
+# (the lookup method and cache do not apply to it). A StageRecorder collects
+# the time and memory of each stage
+def process_eqrm_data_and_find_closest(row, sites_df, export_grid=False,
+                                       lookup='nearest',
+                                       tile_rows=DEFAULT_TILE_ROWS,
+                                       output_format='csv',
+                                       buf=DEFAULT_BUFFER,
+                                       delta=DEFAULT_DELTA,
+                                       output_dir='.',
+                                       cache=None,
+                                       adaptive=False,
+                                       tolerance=DEFAULT_TOLERANCE,
+                                       recorder=NULL_RECORDER):
+    # Create the PlanarSurface (or MultiSurface) from the row data
+    with recorder.stage('surface'):
+        surf = build_surface(row)
+
+    if not export_grid:
+        # Site-only mode: N points instead of the whole buffered bounding box
+        r_rup, r_jb, r_x, r_y0 = get_site_distances(surf, sites_df, recorder)
+        with recorder.stage('records'):
+            return closest_point_records(row, sites_df, r_rup, r_jb, r_x,
+                                         r_y0)
+
+    if adaptive:
+        if hasattr(surf, 'surfaces'):
+            raise ValueError("The adaptive grid supports single-segment "
+                             "ruptures only (%s)" % event_name(row))
+        with recorder.stage('adaptive_grid'):
+            grid = AdaptiveDistanceGrid(surf, buf, delta, tolerance)
+        with recorder.stage('write'):
+            grid.write(os.path.join(output_dir, f"{event_name(row)}"),
+                       output_format)
+        with recorder.stage('lookup'):
+            r_rup, r_jb, r_x, r_y0 = grid.sample(
+                sites_df['Long'].to_numpy(dtype=float),
+                sites_df['Lat'].to_numpy(dtype=float))
+        with recorder.stage('records'):
+            return closest_point_records(row, sites_df, r_rup, r_jb, r_x,
+                                         r_y0)
+
+    # Get bounding box
+    min_lon, max_lon, max_lat, min_lat = surf.get_bounding_box()
+    min_lon -= buf
+    max_lon += buf
+    min_lat -= buf
+    max_lat += buf
+
+    # Grid axes; the mesh itself is only ever built one tile at a time
+    lon_axis = np.arange(min_lon, max_lon + delta, delta)
+    lat_axis = np.arange(min_lat, max_lat + delta, delta)
+    index = RegularGridIndex(lon_axis[0], lat_axis[0], delta,
+                             lon_axis.size, lat_axis.size)
+    reducer = SiteGridReducer(index,
+                              sites_df['Long'].to_numpy(dtype=float),
+                              sites_df['Lat'].to_numpy(dtype=float),
+                              method=lookup)
+
+    # Reuse the distance field of an identical rupture grid if cached
+    cached = None
+    cache_writer = NullGridWriter('', index)
+    if cache is not None:
+        key = distance_cache_key(row, buf, delta)
+        cached = cache.load(key, index)
+        if cached is None:
+            cache_writer = cache.writer(key, index)
+
+    # Stream each tile to the event's grid file, the cache and the site lookup
+    basename = os.path.join(output_dir, f"{event_name(row)}")
+    with GRID_WRITERS[output_format](basename, index) as writer, cache_writer:
+        for row_start, nrows, mesh, fields in iter_grid_tiles(
+                surf, lon_axis, lat_axis, tile_rows, reducer.overlap, cached,
+                recorder):
+            with recorder.stage('write'):
+                writer.write_tile(row_start, nrows, mesh, fields)
+            with recorder.stage('cache_write'):
+                cache_writer.write_tile(row_start, nrows, mesh, fields)
+            with recorder.stage('lookup'):
+                reducer.update(row_start, nrows, mesh, fields)
+
+    site_r_rup, site_r_jb, site_r_x, site_r_y0 = reducer.result()
+    with recorder.stage('records'):
+        return closest_point_records(row, sites_df, site_r_rup, site_r_jb,
+                                     site_r_x, site_r_y0)
+
+# Worker for a single event: opens its own handle on the distance cache (if
+# cache_dir is given) and returns the records with the cache hits and misses
+# and, with instrument, the time and memory of each stage (see StageRecorder)
+def _run_event(row, sites_df, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+               instrument=False, trace_memory=False, **kwargs):
+    cache = DistanceCache(cache_dir, cache_size) if cache_dir else None
+    if instrument:
+        recorder = StageRecorder(trace_memory)
+    else:
+        recorder = NULL_RECORDER
+    start_time = time.perf_counter()
+    try:
+        records = process_eqrm_data_and_find_closest(
+            row, sites_df, cache=cache, recorder=recorder, **kwargs)
+    finally:
+        recorder.close()
+    stats = {'cache_hits': cache.hits if cache else 0,
+             'cache_misses': cache.misses if cache else 0}
+    if instrument:
+        stats['seconds'] = time.perf_counter() - start_time
+        stats['stages'] = recorder.result()
+    return records, stats
+
+
+# Runs the events (as from iter_event_rows) and yields (i, result, error) as
+# each completes, result being the return value of _run_event, or None when it
+# raised error. With workers > 1 the events are fanned out to a process pool;
+# the events not yet started are cancelled when the caller stops iterating
+def _iter_event_results(rows, sites_df, workers=1, **kwargs):
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_run_event, row, sites_df, **kwargs): i
+                for i, row in enumerate(rows)}
+            try:
+                for future in as_completed(futures):
+                    error = future.exception()
+                    yield (futures[future],
+                           None if error else future.result(), error)
+            finally:
+                for future in futures:
+                    future.cancel()
+    else:
+        for i, row in enumerate(rows):
+            try:
+                result = _run_event(row, sites_df, **kwargs)
+            except Exception as error:
+                yield i, None, error
+            else:
+                yield i, result, None
+
+
+# Stage record of a completed event, as passed to stage_log
+def _stage_record(row, stats):
+    return {'eqe_name': str(event_name(row)),
+            'seconds': stats['seconds'],
+            'stages': stats['stages']}
+
+
+# Runs every event of the events file and merges the closest-point records in
+# the order of the events file. With workers > 1 the events are fanned out to
+# a process pool, each worker writing its own per-event grid output;
+# progress(done, total, eqe_name) is called as each event completes, and with
+# instrument=True stage_log(record) with the stage timings of the event. The
+# first failing event aborts the run (see run_events_resumable otherwise).
+# Returns the records and the run statistics (distance cache hits/misses)
+def run_events(input_events_df, sites_df, workers=1, progress=None,
+               stage_log=None, **kwargs):
+    rows = list(iter_event_rows(input_events_df))
+    results = [None] * len(rows)
+    with closing(_iter_event_results(rows, sites_df, workers,
+                                     **kwargs)) as events:
+        for done, (i, result, error) in enumerate(events, 1):
+            if error is not None:
+                raise error
+            results[i] = result
+            if stage_log and 'stages' in result[1]:
+                stage_log(_stage_record(rows[i], result[1]))
+            if progress:
+                progress(done, len(rows), event_name(rows[i]))
+    stats = {'cache_hits': sum(result[1]['cache_hits'] for result in results),
+             'cache_misses': sum(result[1]['cache_misses'] for result in results)}
+    return [record for records, _ in results for record in records], stats
+
+
+# Settings of process_eqrm_data_and_find_closest that change its outputs, as
+# hashed into the checkpoint of each event
+OUTPUT_SETTINGS = ['export_grid', 'lookup', 'output_format', 'buf', 'delta',
+                   'adaptive', 'tolerance']
+
+
+# Content hash of an event's input rows, the sites and the output settings
+def event_digest(row, sites_digest, settings):
+    segments = [[str(segment[column]) for column in REQUIRED_EVENTS_COLUMNS]
+                for segment in event_segments(row)]
+    payload = json.dumps([segments, sites_digest, settings], sort_keys=True,
+                         default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# Grid files whose presence marks an event's grid output as complete (the
+# sidecar or manifest is written last)
+def event_outputs(eqe_name, output_dir='.', export_grid=False,
+                  output_format='csv', adaptive=False, **kwargs):
+    basename = os.path.join(output_dir, f"{eqe_name}")
+    if not export_grid or output_format == 'none':
+        return []
+    if adaptive or output_format != 'csv':
+        return [basename + '.json']
+    return [basename + '.csv']
+
+
+# Number of complete closest-point rows of each eqe_name in the closest-point
+# file (empty when the file is missing or empty)
+def recorded_events(output_file):
+    import pandas as pd
+    try:
+        closest_df = pd.read_csv(output_file, dtype=str, keep_default_na=False,
+                                 on_bad_lines='skip')
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return {}
+    if 'eqe_name' not in closest_df:
+        return {}
+    # A truncated last line leaves its trailing columns empty
+    closest_df = closest_df[closest_df.iloc[:, -1].notna()]
+    return closest_df['eqe_name'].value_counts().to_dict()
+
+
+# Manifest of a resumable run: for each eqe_name its input hash, status
+# ('done' or 'failed'), outputs (the closest-point file and the grid files),
+# number of closest-point rows and the error of a failed event. Saved
+# (atomically) after every change
+class EventCheckpoint(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as fid:
+                self.events = json.load(fid)['events']
+        except FileNotFoundError:
+            self.events = {}
+
+    # recorded is the row count of each eqe_name in the closest-point file
+    # (see recorded_events); a done event whose rows are missing is redone
+    def is_done(self, eqe_name, digest, recorded):
+        entry = self.events.get(str(eqe_name))
+        return (entry is not None and entry['status'] == 'done' and
+                entry['hash'] == digest and
+                all(os.path.exists(path) for path in entry['outputs']) and
+                recorded.get(str(eqe_name), 0) == entry.get('records'))
+
+    def mark(self, eqe_name, digest, status, outputs=(), error=None,
+             records=0):
+        self.events[str(eqe_name)] = {'hash': digest, 'status': status,
+                                      'outputs': list(outputs),
+                                      'records': records, 'error': error}
+        self.save()
+
+    def failed(self):
+        return {name: entry['error'] for name, entry in self.events.items()
+                if entry['status'] == 'failed'}
+
+    def save(self):
+        staging_file = self.filename + '.tmp'
+        with open(staging_file, 'w') as fid:
+            json.dump({'events': self.events}, fid, indent=2)
+        os.replace(staging_file, self.filename)
+
+
+# Rewrite the closest-point file keeping only the rows of the given events, in
+# the order of `order` (eqe_name -> position); values are copied as text
+def _rewrite_closest_points(output_file, order):
+    import pandas as pd
+    try:
+        closest_df = pd.read_csv(output_file, dtype=str, keep_default_na=False,
+                                 on_bad_lines='skip')
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return
+    closest_df = closest_df[closest_df['eqe_name'].isin(order)]
+    closest_df = closest_df.iloc[np.argsort(
+        closest_df['eqe_name'].map(order).to_numpy(), kind='stable')]
+    staging_file = output_file + '.tmp'
+    closest_df.to_csv(staging_file, index=False)
+    os.replace(staging_file, output_file)
+
+
+# Resumable run: appends the records of each completed event to
+# CLOSEST_POINTS_FILE in output_dir and records the event in the
+# CHECKPOINT_FILE manifest with a hash of its input rows, the sites and the
+# output settings. Rerunning skips the events whose hash matches and whose
+# closest-point rows and grid outputs exist. A failing event is recorded in the manifest instead of
+# aborting the run and retried up to `retries` more times, serially, once the
+# other events are done (and again on the next run). The output is finally
+# sorted into the order of the events file. Returns its path and the run
+# statistics (cache hits/misses, skipped events, failed events and errors)
+def run_events_resumable(input_events_df, sites_df, output_dir='.', workers=1,
+                         progress=None, stage_log=None, retries=1, **kwargs):
+    import pandas as pd
+    output_file = os.path.join(output_dir, CLOSEST_POINTS_FILE)
+    checkpoint = EventCheckpoint(os.path.join(output_dir, CHECKPOINT_FILE))
+    sites_digest = hashlib.sha256(
+        sites_df[REQUIRED_SITES_COLUMNS].to_csv(index=False).encode()
+    ).hexdigest()
+    settings = {name: kwargs[name] for name in OUTPUT_SETTINGS
+                if name in kwargs}
+    rows = list(iter_event_rows(input_events_df))
+    names = [str(event_name(row)) for row in rows]
+    digests = [event_digest(row, sites_digest, settings) for row in rows]
+    recorded = recorded_events(output_file)
+    pending = [i for i in range(len(rows))
+               if not checkpoint.is_done(names[i], digests[i], recorded)]
+
+    # Drop the rows of events that are not (or no longer) complete
+    incomplete = set(pending)
+    _rewrite_closest_points(output_file, {
+        name: i for i, name in enumerate(names) if i not in incomplete})
+
+    stats = {'cache_hits': 0, 'cache_misses': 0,
+             'skipped': len(rows) - len(pending)}
+    total = len(pending)
+    count = 0
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        failed = []
+        with closing(_iter_event_results(
+                [rows[i] for i in pending], sites_df,
+                workers if attempt == 0 else 1,
+                output_dir=output_dir, **kwargs)) as events:
+            for j, result, error in events:
+                i = pending[j]
+                outputs = [output_file] + event_outputs(
+                    names[i], output_dir, **kwargs)
+                if error is not None:
+                    failed.append(i)
+                    checkpoint.mark(names[i], digests[i], 'failed', outputs,
+                                    '%s: %s' % (type(error).__name__, error))
+                    continue
+                records, event_stats = result
+                header = not os.path.exists(output_file) or \
+                    os.path.getsize(output_file) == 0
+                with open(output_file, 'a', newline='') as fid:
+                    pd.DataFrame(records).to_csv(fid, header=header,
+                                                 index=False)
+                checkpoint.mark(names[i], digests[i], 'done', outputs,
+                                records=len(records))
+                stats['cache_hits'] += event_stats['cache_hits']
+                stats['cache_misses'] += event_stats['cache_misses']
+                if stage_log and 'stages' in event_stats:
+                    stage_log(_stage_record(rows[i], event_stats))
+                count += 1
+                if progress:
+                    progress(count, total, names[i])
+        pending = failed
+
+    # Event order, without the events that still fail
+    failed = set(pending)
+    _rewrite_closest_points(output_file, {
+        name: i for i, name in enumerate(names) if i not in failed})
+    stats['failed'] = {names[i]: checkpoint.events[names[i]]['error']
+                       for i in pending}
+    return output_file, stats
+
+
+# Batched distance engine. Evaluates Rrup, Rjb, Rx and Ry0 for all (event,
+# site) pairs of a set of planar ruptures with array operations over blocks of
+# events, instead of one PlanarSurface and four OpenQuake calls per event. The
+# formulas are those of OpenQuake's planar surface, applied to (events, sites)
+# arrays; validate_batched_distances checks them against PlanarSurface
+
+def _spherical_to_cartesian(lons, lats, depths):
+    lons = np.radians(lons)
+    lats = np.radians(lats)
+    radius = EARTH_RADIUS - depths
+    cos_lats = np.cos(lats)
+    return np.stack((radius * cos_lats * np.cos(lons),
+                     radius * cos_lats * np.sin(lons),
+                     radius * np.sin(lats)), axis=-1)
+
+
+# Signed distances (km) from the points to the great-circle arcs through
+# (lon, lat) with the given azimuth, negative on the right of the arc. lon, lat
+# and azimuth are (events, 1) columns and lons, lats (sites,) rows
+def _arc_distances(lon, lat, azimuth, lons, lats):
+    lon, lat, azimuth = np.radians(lon), np.radians(lat), np.radians(azimuth)
+    lons, lats = np.radians(lons), np.radians(lats)
+    cos_lats = np.cos(lats)
+    azimuth_to_target = -np.arctan2(
+        np.sin(lon - lons) * cos_lats,
+        np.cos(lat) * np.sin(lats) - np.sin(lat) * cos_lats * np.cos(lon - lons))
+    distance_to_target = 2. * np.arcsin(np.sqrt(
+        np.sin((lat - lats) / 2.) ** 2 +
+        np.cos(lat) * cos_lats * np.sin((lon - lons) / 2.) ** 2))
+    angle = np.arccos(np.sin(azimuth_to_target - azimuth) *
+                      np.sin(distance_to_target))
+    return (np.pi / 2. - angle) * EARTH_RADIUS
+
+
+# Plane geometry of a set of planar ruptures (rows of the events file), with
+# the corners ordered top left, top right, bottom left, bottom right
+class PlanarRuptureBatch(object):
+
+    def __init__(self, events_df):
+        if events_df['eqe_name'].duplicated().any():
+            raise ValueError("The batched engine supports single-segment "
+                             "ruptures only (one row per eqe_name)")
+        corners = ['top_left', 'top_right', 'bottom_left', 'bottom_right']
+        self.names = events_df['eqe_name'].to_numpy()
+        self.strike = events_df['strike'].to_numpy(dtype=float)
+        self.lons = events_df[[c + '_lon' for c in corners]].to_numpy(dtype=float)
+        self.lats = events_df[[c + '_lat' for c in corners]].to_numpy(dtype=float)
+        depths = events_df[[c + '_depth' for c in corners]].to_numpy(dtype=float)
+        xyz = _spherical_to_cartesian(self.lons, self.lats, depths)
+        self.xyz = xyz
+        tl, tr, bl, br = (xyz[:, i] for i in range(4))
+        self.normal = self._normalized(np.cross(tl - tr, tl - bl))
+        self.uv1 = self._normalized(tr - tl)
+        self.uv2 = np.cross(self.normal, self.uv1)
+        offsets = xyz - tl[:, None, :]
+        xx = np.einsum('eck,ek->ec', offsets, self.uv1)
+        yy = np.einsum('eck,ek->ec', offsets, self.uv2)
+        self.length = ((xx[:, 1] - xx[:, 0]) + (xx[:, 3] - xx[:, 2])) / 2.
+        self.width = ((yy[:, 2] - yy[:, 0]) + (yy[:, 3] - yy[:, 1])) / 2.
+        # Corner projections on the Earth surface, for Rjb
+        self.surface_xyz = _spherical_to_cartesian(self.lons, self.lats, 0.)
+
+    def __len__(self):
+        return self.strike.size
+
+    @staticmethod
+    def _normalized(vectors):
+        return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    def distances(self, site_lons, site_lats, start=0, stop=None):
+        # Rrup, Rjb, Rx and Ry0 of events start:stop at the sites, each an
+        # (events, sites) array
+        ev = slice(start, stop)
+        site_lons = np.asarray(site_lons, dtype=float)
+        site_lats = np.asarray(site_lats, dtype=float)
+        sites = _spherical_to_cartesian(site_lons, site_lats, 0.)
+        lons, lats = self.lons[ev], self.lats[ev]
+        strike = self.strike[ev][:, None]
+        downdip = (strike + 90.) % 360
+
+        # Rrup: distance to the plane combined with the distance, within the
+        # plane, to the rectangle
+        tl = self.xyz[ev, 0]
+
+        def project(vectors):
+            return sites @ vectors.T - np.sum(tl * vectors, axis=1)
+
+        dists = project(self.normal[ev]).T
+        xx = project(self.uv1[ev]).T
+        yy = project(self.uv2[ev]).T
+        length = self.length[ev][:, None]
+        width = self.width[ev][:, None]
+        mxx = np.where(xx < 0, xx, np.where(xx > length, xx - length, 0.))
+        myy = np.where(yy < 0, yy, np.where(yy > width, yy - width, 0.))
+        r_rup = np.sqrt(dists ** 2 + mxx ** 2 + myy ** 2)
+
+        # Rjb: position relative to the arcs through the projected edges,
+        # either inside (zero), beside one pair of edges (distance to the
+        # closer edge) or off a corner (distance to the closest corner)
+        arcs = [_arc_distances(lons[:, i:i + 1], lats[:, i:i + 1], azimuth,
+                               site_lons, site_lats)
+                for i, azimuth in ((2, strike), (0, strike),
+                                   (0, downdip), (1, downdip))]
+        signs = [np.sign(arc) for arc in arcs]
+        corners = np.sqrt(np.min(np.sum(
+            (self.surface_xyz[ev][:, :, None, :] - sites[None, None]) ** 2,
+            axis=-1), axis=1))
+        r_jb = np.select(
+            [(signs[0] == signs[1]) & (signs[2] == signs[3]),
+             signs[0] == signs[1],
+             signs[2] == signs[3]],
+            [corners,
+             np.fmin(np.abs(arcs[0]), np.abs(arcs[1])),
+             np.fmin(np.abs(arcs[2]), np.abs(arcs[3]))],
+            default=0.)
+
+        # Rx: distance to the arc along the strike through the top left
+        # corner, as PlanarSurface (which takes the strike column, not the
+        # corner azimuth); Ry0: distance to the closer of the arcs
+        # perpendicular to strike through the top edge ends
+        r_x = arcs[1]
+        r_y0 = _ry0_from_arcs(arcs[2], arcs[3])
+        return r_rup, r_jb, r_x, r_y0
+
+    def iter_blocks(self, site_lons, site_lats, block=DEFAULT_EVENT_BLOCK):
+        # (start, stop, distances) for successive blocks of events, bounding
+        # the temporaries to block x sites values each
+        for start in range(0, len(self), block):
+            stop = min(start + block, len(self))
+            yield start, stop, self.distances(site_lons, site_lats,
+                                              start, stop)
+
+
+# Closest-point table of every (event, site) pair from the batched engine, in
+# the order and columns of the per-event records
+def batched_closest_points(input_events_df, sites_df, block=DEFAULT_EVENT_BLOCK,
+                           progress=None):
+    import pandas as pd
+    batch = PlanarRuptureBatch(input_events_df)
+    site_lons = sites_df['Long'].to_numpy(dtype=float)
+    site_lats = sites_df['Lat'].to_numpy(dtype=float)
+    frames = []
+    for start, stop, fields in batch.iter_blocks(site_lons, site_lats, block):
+        nevents = stop - start
+        frame = {
+            'eqe_name': np.repeat(batch.names[start:stop], site_lons.size),
+            'Strong Motion Site': np.tile(
+                sites_df['Strong Motion Site'].to_numpy(), nevents),
+            'SiteLat': np.tile(site_lats, nevents),
+            'SiteLong': np.tile(site_lons, nevents)
+        }
+        for column, values in zip(GRID_COLUMNS, fields):
+            frame[column] = np.ravel(values)
+        frames.append(pd.DataFrame(frame))
+        if progress:
+            progress(stop, len(batch), batch.names[stop - 1])
+    return pd.concat(frames, ignore_index=True)
+
+
+# Largest absolute difference (km) of each metric between the batched engine
+# and the PlanarSurface methods over all events and sites; raises ValueError
+# when any exceeds tolerance
+def validate_batched_distances(input_events_df, sites_df,
+                               tolerance=BATCH_TOLERANCE):
+    batch = PlanarRuptureBatch(input_events_df)
+    site_lons = sites_df['Long'].to_numpy(dtype=float)
+    site_lats = sites_df['Lat'].to_numpy(dtype=float)
+    errors = dict.fromkeys(GRID_COLUMNS, 0.)
+    for start, stop, fields in batch.iter_blocks(site_lons, site_lats):
+        for i in range(start, stop):
+            surf = build_planar_surface(input_events_df.iloc[i])
+            expected = get_site_distances(surf, sites_df)
+            for column, values, reference in zip(GRID_COLUMNS, fields,
+                                                 expected):
+                error = np.max(np.abs(values[i - start] - reference))
+                errors[column] = max(errors[column], float(error))
+    if max(errors.values()) > tolerance:
+        raise ValueError("Batched distances differ from PlanarSurface by "
+                         "more than %g km: %s" % (tolerance, errors))
+    return errors
+
+
+# Load the sites and events files, checking for the required columns
+def load_inputs(sites_file, events_file):
+    import pandas as pd
+    sites_df = pd.read_csv(sites_file)
+    input_events_df = pd.read_csv(events_file)
+
+    # Check for required columns in sites_df
+    if not all(column in sites_df.columns for column in REQUIRED_SITES_COLUMNS):
+        raise ValueError("Sites CSV file does not contain required columns.")
+
+    # Check for required columns in input_events_df
+    if not all(column in input_events_df.columns for column in REQUIRED_EVENTS_COLUMNS):
+        raise ValueError("Events CSV file does not contain required columns.")
+    return sites_df, input_events_df
+
+
+# Write the merged closest-point records (a list of records or a DataFrame);
+# returns the path of the file
+def write_closest_points(closest_data, output_dir='.'):
+    import pandas as pd
+    output_file = os.path.join(output_dir, CLOSEST_POINTS_FILE)
+    pd.DataFrame(closest_data).to_csv(output_file, index=False)
+    # The file no longer matches the checkpoint of an earlier resumable run
+    checkpoint_file = os.path.join(output_dir, CHECKPOINT_FILE)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return output_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compute Rrup, Rjb, Rx and Ry0 from EQRM planar "
+                    "ruptures to a list of strong-motion sites")
+    parser.add_argument('sites_file', help="Sites CSV (Lat, Long, Strong Motion Site)")
+    parser.add_argument('events_file', help="Events CSV (rupture corners, strike, dip, eqe_name)")
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help="Directory for %s and the event grids" % CLOSEST_POINTS_FILE)
+    parser.add_argument('--delta', type=float, default=DEFAULT_DELTA,
+                        help="Grid spacing in degrees (default %(default)s)")
+    parser.add_argument('--buffer', type=float, default=DEFAULT_BUFFER,
+                        help="Buffer around the rupture in degrees (default %(default)s)")
+    parser.add_argument('--export-grid', action='store_true',
+                        help="Build and write the full distance grid of each event")
+    parser.add_argument('--lookup', choices=LOOKUP_METHODS, default='nearest',
+                        help="Site lookup on the grid (default %(default)s)")
+    parser.add_argument('--tile-rows', type=int, default=DEFAULT_TILE_ROWS,
+                        help="Grid rows evaluated at once, 0 for the whole grid "
+                             "(default %(default)s)")
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS,
+                        default='csv', help="Grid file format (default %(default)s)")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="Number of worker processes (default %(default)s)")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="Use a multi-resolution grid, coarser away from "
+                             "the rupture (with --export-grid)")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Adaptive grid interpolation error bound in km "
+                             "(default %(default)s)")
+    parser.add_argument('--batched', action='store_true',
+                        help="Evaluate all events at the sites with the "
+                             "batched engine (no grids)")
+    parser.add_argument('--event-block', type=int, default=DEFAULT_EVENT_BLOCK,
+                        help="Events per block of the batched engine "
+                             "(default %(default)s)")
+    parser.add_argument('--validate', action='store_true',
+                        help="Check the batched engine against PlanarSurface "
+                             "before running it")
+    parser.add_argument('--instrument', action='store_true',
+                        help="Log the time and memory of each stage of "
+                             "each event to %s" % RUN_LOG_FILE)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="With --instrument, trace the peak memory of "
+                             "each stage (slower)")
+    parser.add_argument('--resume', action='store_true',
+                        help="Append results as events complete, checkpoint "
+                             "them in %s and skip completed events on rerun"
+                             % CHECKPOINT_FILE)
+    parser.add_argument('--retries', type=int, default=1,
+                        help="With --resume, times failed events are retried "
+                             "(default %(default)s)")
+    parser.add_argument('--cache-dir', default=None,
+                        help="Cache the event distance grids in this directory")
+    parser.add_argument('--cache-size', type=float,
+                        default=DEFAULT_CACHE_SIZE / 1024 ** 3,
+                        help="Cache size limit in GB (default %(default)s)")
+    args = parser.parse_args(argv)
+
+    start_time = time.time()
+    os.makedirs(args.output_dir, exist_ok=True)
+    sites_df, input_events_df = load_inputs(args.sites_file, args.events_file)
+
+    def progress(done, total, eqe_name):
+        print(f"Processed {done}/{total} events (last: {eqe_name})",
+              file=sys.stderr)
+
+    if args.batched:
+        if args.export_grid or args.instrument or args.resume:
+            parser.error("--batched evaluates the sites only, without grids, "
+                         "stage instrumentation or checkpoints")
+        if args.validate:
+            errors = validate_batched_distances(input_events_df, sites_df)
+            print("Batched engine within %g km of PlanarSurface (max "
+                  "differences: %s)" % (BATCH_TOLERANCE, errors),
+                  file=sys.stderr)
+        closest_data = batched_closest_points(input_events_df, sites_df,
+                                              args.event_block, progress)
+        stats = {'cache_hits': 0, 'cache_misses': 0}
+    else:
+        run_log = None
+        if args.instrument:
+            run_log = RunLog(os.path.join(args.output_dir, RUN_LOG_FILE))
+
+        def stage_log(record):
+            run_log(record)
+            print(f"{record['eqe_name']}: {format_stages(record['stages'])}",
+                  file=sys.stderr)
+
+        options = dict(
+            instrument=args.instrument, trace_memory=args.trace_memory,
+            export_grid=args.export_grid, lookup=args.lookup,
+            tile_rows=args.tile_rows or None, output_format=args.output_format,
+            buf=args.buffer, delta=args.delta,
+            adaptive=args.adaptive, tolerance=args.tolerance,
+            cache_dir=args.cache_dir,
+            cache_size=int(args.cache_size * 1024 ** 3))
+        try:
+            if args.resume:
+                output_file, stats = run_events_resumable(
+                    input_events_df, sites_df, output_dir=args.output_dir,
+                    workers=args.workers, progress=progress,
+                    stage_log=stage_log if run_log else None,
+                    retries=args.retries, **options)
+            else:
+                closest_data, stats = run_events(
+                    input_events_df, sites_df, workers=args.workers,
+                    progress=progress,
+                    stage_log=stage_log if run_log else None,
+                    output_dir=args.output_dir, **options)
+        finally:
+            if run_log:
+                run_log.close()
+    if not args.resume:
+        output_file = write_closest_points(closest_data, args.output_dir)
+    print(f"Saved {output_file} in {time.time() - start_time:.2f} seconds")
+    if args.cache_dir:
+        print(f"Distance cache: {stats['cache_hits']} hits, "
+              f"{stats['cache_misses']} misses")
+    if args.resume:
+        print(f"Skipped {stats['skipped']} completed events")
+        for eqe_name, error in stats['failed'].items():
+            print(f"Failed {eqe_name}: {error}", file=sys.stderr)
+        if stats['failed']:
+            return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""
+Benchmarks of the rupture distance pipeline. Generates synthetic sites and
+events CSVs with the required columns, times the calculator over a matrix of
+grid spacings, buffers, rupture sizes, site counts and modes, and saves the
+throughput (grid points/s, sites/s) and peak RSS of each case as JSON:
+
+    python rupture_calc_bench.py -o bench.json
+    python rupture_calc_bench.py -o new.json --compare bench.json
+
+Each case runs in its own process so that its peak RSS is its own.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from rupture_calc import (
+    EARTH_RADIUS, DEFAULT_TOLERANCE, REQUIRED_EVENTS_COLUMNS, load_inputs,
+    iter_event_rows, build_surface, process_eqrm_data_and_find_closest,
+    batched_closest_points, AdaptiveDistanceGrid, _max_rss
+)
+
+# Modes: exact distances at the sites, uniform or adaptive grid with site
+# lookup (nothing written), and the batched engine
+MODES = ['sites', 'grid', 'adaptive', 'batched']
+
+# Modes whose cost depends on the grid spacing and buffer
+GRID_MODES = ['grid', 'adaptive']
+
+DEFAULT_MATRIX = {
+    'mode': ['sites', 'grid'],
+    'delta': [0.004, 0.002],
+    'buf': [0.5, 1.0],
+    'length': [10., 40.],
+    'sites': [100, 1000],
+    'events': [1]
+}
+
+# Centre of the synthetic ruptures and sites
+CENTER_LON = 125.0
+CENTER_LAT = 11.0
+
+
+# Point at a great-circle distance (km) and azimuth (degrees) from lon, lat
+def _point_at(lon, lat, azimuth, distance):
+    lon, lat, azimuth = np.radians([lon, lat, azimuth])
+    angle = distance / EARTH_RADIUS
+    lat2 = np.arcsin(np.sin(lat) * np.cos(angle) +
+                     np.cos(lat) * np.sin(angle) * np.cos(azimuth))
+    lon2 = lon + np.arctan2(np.sin(azimuth) * np.sin(angle) * np.cos(lat),
+                            np.cos(angle) - np.sin(lat) * np.sin(lat2))
+    return float(np.degrees(lon2)), float(np.degrees(lat2))
+
+
+# Events CSV rows of n planar ruptures of the given length and width (km)
+# with random strikes, centred near CENTER_LON, CENTER_LAT
+def synthetic_events(n, length, width=None, dip=45., ztor=1., seed=0):
+    rng = np.random.default_rng(seed)
+    width = width or length / 2.
+    horizontal = width * np.cos(np.radians(dip))
+    bottom = ztor + width * np.sin(np.radians(dip))
+    rows = []
+    for i in range(n):
+        strike = float(rng.uniform(0., 360.))
+        lon, lat = _point_at(CENTER_LON, CENTER_LAT, rng.uniform(0., 360.),
+                             rng.uniform(0., 10.))
+        top_left = _point_at(lon, lat, (strike + 180.) % 360, length / 2.)
+        top_right = _point_at(top_left[0], top_left[1], strike, length)
+        bottom_left = _point_at(top_left[0], top_left[1],
+                                (strike + 90.) % 360, horizontal)
+        bottom_right = _point_at(top_right[0], top_right[1],
+                                 (strike + 90.) % 360, horizontal)
+        rows.append([strike, dip,
+                     top_left[0], top_left[1], ztor,
+                     top_right[0], top_right[1], ztor,
+                     bottom_left[0], bottom_left[1], bottom,
+                     bottom_right[0], bottom_right[1], bottom,
+                     'bench%d' % i])
+    return rows
+
+
+# Sites CSV rows of n sites spread uniformly over +/- extent degrees
+def synthetic_sites(n, extent=1., seed=0):
+    rng = np.random.default_rng(seed)
+    lats = rng.uniform(CENTER_LAT - extent, CENTER_LAT + extent, n)
+    lons = rng.uniform(CENTER_LON - extent, CENTER_LON + extent, n)
+    return [[float(lat), float(lon), 'S%d' % i]
+            for i, (lat, lon) in enumerate(zip(lats, lons))]
+
+
+def write_inputs(directory, case, seed=0):
+    import pandas as pd
+    sites_file = os.path.join(directory, 'sites.csv')
+    events_file = os.path.join(directory, 'events.csv')
+    pd.DataFrame(synthetic_sites(case['sites'], case.get('buf', 1.), seed),
+                 columns=['Lat', 'Long', 'Strong Motion Site']).to_csv(
+        sites_file, index=False)
+    pd.DataFrame(synthetic_events(case['events'], case['length'], seed=seed),
+                 columns=REQUIRED_EVENTS_COLUMNS).to_csv(events_file,
+                                                         index=False)
+    return sites_file, events_file
+
+
+# Number of grid points a case evaluates per event (0 without a grid)
+def grid_points(row, case):
+    if case['mode'] == 'grid':
+        west, east, north, south = build_surface(row).get_bounding_box()
+        nlon = np.arange(west - case['buf'], east + case['buf'] + case['delta'],
+                         case['delta']).size
+        nlat = np.arange(south - case['buf'], north + case['buf'] + case['delta'],
+                         case['delta']).size
+        return nlon * nlat
+    if case['mode'] == 'adaptive':
+        return AdaptiveDistanceGrid(build_surface(row), case['buf'],
+                                    case['delta'], DEFAULT_TOLERANCE).size
+    return 0
+
+
+# Runs one case in the current process, best of `repeat` runs
+def run_case(case, repeat=1):
+    with tempfile.TemporaryDirectory() as directory:
+        sites_file, events_file = write_inputs(directory, case)
+        sites_df, input_events_df = load_inputs(sites_file, events_file)
+        rows = list(iter_event_rows(input_events_df))
+        # Load OpenQuake outside of the timed region
+        build_surface(rows[0])
+        timings = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            if case['mode'] == 'batched':
+                batched_closest_points(input_events_df, sites_df)
+            else:
+                for row in rows:
+                    process_eqrm_data_and_find_closest(
+                        row, sites_df,
+                        export_grid=case['mode'] in GRID_MODES,
+                        adaptive=case['mode'] == 'adaptive',
+                        output_format='none',
+                        buf=case.get('buf'), delta=case.get('delta'),
+                        output_dir=directory)
+            timings.append(time.perf_counter() - start_time)
+        points = sum(grid_points(row, case) for row in rows)
+    seconds = min(timings)
+    return dict(case, seconds=seconds, grid_points=int(points),
+                grid_points_per_s=points / seconds,
+                sites_per_s=case['sites'] * case['events'] / seconds,
+                max_rss_bytes=_max_rss())
+
+
+# Runs one case in a fresh interpreter and returns its result
+def run_case_subprocess(case, repeat=1):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-case',
+         json.dumps(case), '--repeat', str(repeat)],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# Cases of the matrix; the grid spacing and buffer only vary in grid modes
+def iter_cases(matrix):
+    seen = set()
+    for mode, delta, buf, length, sites, events in itertools.product(
+            matrix['mode'], matrix['delta'], matrix['buf'], matrix['length'],
+            matrix['sites'], matrix['events']):
+        case = {'mode': mode, 'length': length, 'sites': sites,
+                'events': events}
+        if mode in GRID_MODES:
+            case.update(delta=delta, buf=buf)
+        key = case_key(case)
+        if key not in seen:
+            seen.add(key)
+            yield case
+
+
+def case_key(case):
+    return tuple(case.get(name) for name in
+                 ('mode', 'delta', 'buf', 'length', 'sites', 'events'))
+
+
+def describe(case):
+    text = '%-8s L=%gkm sites=%d events=%d' % (
+        case['mode'], case['length'], case['sites'], case['events'])
+    if case['mode'] in GRID_MODES:
+        text += ' delta=%g buf=%g' % (case['delta'], case['buf'])
+    return text
+
+
+def metadata():
+    versions = {'python': platform.python_version(), 'numpy': np.__version__}
+    try:
+        from openquake.baselib import __version__ as oq_version
+        versions['openquake'] = oq_version
+    except ImportError:
+        pass
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'versions': versions}
+
+
+# Print the speed-up of each case over a baseline results file
+def compare(results, baseline_file):
+    with open(baseline_file) as fid:
+        baseline = {case_key(result): result
+                    for result in json.load(fid)['results']}
+    print('%-60s %10s %10s %8s' % ('case', 'base [s]', 'new [s]', 'speedup'))
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None:
+            print('%-60s %10s %10.3f %8s' % (describe(result), '-',
+                                             result['seconds'], '-'))
+            continue
+        print('%-60s %10.3f %10.3f %7.2fx' % (
+            describe(result), old['seconds'], result['seconds'],
+            old['seconds'] / result['seconds']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the rupture distance calculator")
+    parser.add_argument('-o', '--output', default='rupture_calc_bench.json',
+                        help="Results file (default %(default)s)")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="Results file to compare against")
+    parser.add_argument('--mode', nargs='+', choices=MODES,
+                        default=DEFAULT_MATRIX['mode'])
+    parser.add_argument('--delta', nargs='+', type=float,
+                        default=DEFAULT_MATRIX['delta'],
+                        help="Grid spacings in degrees")
+    parser.add_argument('--buf', nargs='+', type=float,
+                        default=DEFAULT_MATRIX['buf'],
+                        help="Buffers around the rupture in degrees")
+    parser.add_argument('--length', nargs='+', type=float,
+                        default=DEFAULT_MATRIX['length'],
+                        help="Rupture lengths in km (width is half the length)")
+    parser.add_argument('--sites', nargs='+', type=int,
+                        default=DEFAULT_MATRIX['sites'],
+                        help="Site counts")
+    parser.add_argument('--events', nargs='+', type=int,
+                        default=DEFAULT_MATRIX['events'],
+                        help="Events per case")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Runs per case, the fastest is kept "
+                             "(default %(default)s)")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case), args.repeat)))
+        return
+
+    matrix = {'mode': args.mode, 'delta': args.delta, 'buf': args.buf,
+              'length': args.length, 'sites': args.sites,
+              'events': args.events}
+    results = []
+    for case in iter_cases(matrix):
+        result = run_case_subprocess(case, args.repeat)
+        results.append(result)
+        rss = result['max_rss_bytes']
+        print('%-60s %8.3fs %12.0f points/s %10.0f sites/s %8s' % (
+            describe(case), result['seconds'], result['grid_points_per_s'],
+            result['sites_per_s'],
+            '%.0fMB' % (rss / 1024 ** 2) if rss else '-'), file=sys.stderr)
+    with open(args.output, 'w') as fid:
+        json.dump({'metadata': metadata(), 'matrix': matrix,
+                   'results': results}, fid, indent=2)
+    print("Saved %s" % args.output, file=sys.stderr)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
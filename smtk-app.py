@@ -1,19 +1,22 @@
 # Import the modules
 # %matplotlib inline
+# pandas, seaborn, matplotlib and the SMTK/OpenQuake stack are only imported
+# when processing starts, so that the window opens straight away
 import numpy as np
-import smtk.trellis.trellis_plots as trpl
-from openquake.hazardlib.gsim import get_available_gsims
 import warnings
 warnings.filterwarnings("ignore")
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
-import smtk.trellis.configure as rcfg
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from math import floor, ceil
 import tkinter as tk
 from tkinter import filedialog, messagebox, Label
 import customtkinter
 
+import smtk_render
+
 
 def get_base_name(file_path):
     return os.path.splitext(os.path.basename(file_path))[0]
@@ -34,6 +37,72 @@ def create_label(year, magnitude, pga, distances):
             f'ry0: {distances["ry0"]}')
 
 
+# Hashable form of a scenario value (NaN compares equal to NaN)
+def scenario_value(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(scenario_value(val) for val in value)
+    if isinstance(value, (float, np.floating)) and np.isnan(value):
+        return None
+    return value
+
+
+class ScenarioCache:
+    """
+    Trellis objects of the scenarios met so far in a run. Rows sharing a
+    scenario share the trellis, so its ground motions are computed once.
+    The magnitude trellis is keyed on the distances and rupture/site
+    parameters the GMPEs require (REQUIRES_*), the distance trellis on the
+    rupture and site properties its configuration is built from.
+    """
+    def __init__(self, gmpe_list, imts, magnitudes, tables=None):
+        import smtk.trellis.trellis_plots as trpl
+        self.gmpe_list = gmpe_list
+        self.imts = imts
+        self.magnitudes = magnitudes
+        self.tables = tables
+        # Instances are resolved once and shared across rows and runs
+        gsims = trpl.resolve_gsims(gmpe_list).values()
+        self.distance_names = sorted(set().union(
+            *(gsim.REQUIRES_DISTANCES for gsim in gsims)))
+        self.param_names = sorted(set().union(
+            *(gsim.REQUIRES_RUPTURE_PARAMETERS for gsim in gsims),
+            *(gsim.REQUIRES_SITES_PARAMETERS for gsim in gsims)) - {'mag'})
+        self.magnitude_trellises = {}
+        self.distance_trellises = {}
+
+    def magnitude_trellis(self, distances, params):
+        key = (tuple(scenario_value(distances.get(name)) for name in self.distance_names) +
+               tuple(scenario_value(params.get(name)) for name in self.param_names))
+        if key not in self.magnitude_trellises:
+            import smtk.trellis.trellis_plots as trpl
+            self.magnitude_trellises[key] = trpl.MagnitudeIMTTrellis(
+                self.magnitudes, dict(distances), self.gmpe_list, self.imts, dict(params),
+                dpi=400, figure_size=(20, 15), tables=self.tables)
+        return self.magnitude_trellises[key]
+
+    def distance_trellis(self, magnitude, params):
+        key = tuple(scenario_value(val) for val in
+                    (magnitude, params['dip'], params['rake'], params['ztor'], params['vs30']))
+        if key not in self.distance_trellises:
+            import smtk.trellis.trellis_plots as trpl
+            import smtk.trellis.configure as rcfg
+            rupture = rcfg.GSIMRupture(magnitude=magnitude,   # Moment magnitude
+                                       dip=params['dip'],   # Dip of Rupture
+                                       aspect=1.5, # Aspect Ratio of Rupture
+                                       rake=params['rake'],  # Rake of rupture
+                                       ztor=params['ztor'],  # Top of rupture depth
+                                       )
+            # It is critical that before running the trellis plots, the site configuration must be run!!!!
+            _ = rupture.get_target_sites_line(200.0, 1.0, params['vs30'])
+            self.distance_trellises[key] = trpl.DistanceIMTTrellis.from_rupture_model(
+                rupture, self.gmpe_list, self.imts, dpi=400, figure_size=(20, 15),
+                tables=self.tables)
+        return self.distance_trellises[key]
+
+    def __len__(self):
+        return len(self.magnitude_trellises) + len(self.distance_trellises)
+
+
 # def create_radio_buttons(container):
 #     global pga_radio, sa_radio
 
@@ -67,8 +136,146 @@ def create_radio_buttons(container):
     # Grid the radio_frame itself in the container
     radio_frame.grid(row=2, column=0, columnspan=2, sticky="ew")
     
-def process_data(file_path, year):
+# Columns of the input CSV holding the recorded value of an IMT (other IMTs
+# are looked up by their lower-case name, e.g. "sa(1.0)")
+RECORDED_COLUMNS = {"PGA": "pga"}
+
+# Distance and rupture/site parameter columns of the input CSV
+DISTANCE_COLUMNS = ["repi", "rjb", "rrup", "rx", "ry0"]
+PARAM_COLUMNS = ["ztor", "hypo_depth", "dip", "rake", "width", "vs30", "z1pt0", "z2pt5"]
+
+
+# GMPE lookup tables, shared by the CSV files of a folder and extended as new
+# parameter sets come up. A table is built for the recordings sharing the
+# fixed rupture/site parameters of a GMPE when there are enough of them.
+# Tables have a single distance axis, so GMPEs using several distance
+# measures (which differ at real recordings) are always evaluated directly
+GMPE_TABLES_FILE = "gmpe_tables.npz"
+TABLE_MIN_RECORDS = 20
+TABLE_DISTANCES = np.expm1(np.linspace(0.0, np.log1p(300.0), 50))
+TABLE_VS30S = np.geomspace(150.0, 1500.0, 12)
+
+
+# Magnitudes, distances and rupture/site parameters of every recording
+def record_inputs(data):
+    distances = {name: data[name].to_numpy(dtype=float) for name in DISTANCE_COLUMNS}
+    params = {name: data[name].to_numpy(dtype=float) for name in PARAM_COLUMNS}
+    params["vs30measured"] = True  # Assuming Vs30 value is always measured
+    return data['magnitude'].to_numpy(dtype=float), distances, params
+
+
+# Lookup tables of the GMPEs for the recordings of data, loaded from the
+# tables file of the directory and extended with the parameter sets of data
+# not tabulated yet. Returns the tables and the largest interpolation error
+# of the ln-median among them
+def gmpe_tables(data, gmpe_list, imts, magnitudes, directory):
+    import pandas as pd
+    import smtk.trellis.trellis_plots as trpl
+    file_name = os.path.join(directory, GMPE_TABLES_FILE)
+    if os.path.exists(file_name):
+        tables = trpl.GMPETables.from_npz(file_name)
+    else:
+        tables = trpl.GMPETables()
+    record_magnitudes, _, params = record_inputs(data)
+    table_magnitudes = np.arange(min(magnitudes[0], floor(np.nanmin(record_magnitudes))),
+                                 max(magnitudes[-1], ceil(np.nanmax(record_magnitudes))) + 0.05, 0.1)
+    added = 0
+    for gmpe_name, gmpe in trpl.resolve_gsims(gmpe_list).items():
+        if len(gmpe.REQUIRES_DISTANCES) > 1:
+            continue
+        names = sorted((set(gmpe.REQUIRES_RUPTURE_PARAMETERS) |
+                        set(gmpe.REQUIRES_SITES_PARAMETERS)) - {'mag', 'vs30'})
+        if not set(names) <= set(params):
+            continue
+        columns = pd.DataFrame({name: np.broadcast_to(params[name], len(data)) for name in names})
+        groups = columns.groupby(names).size() if names else pd.Series([len(data)])
+        for key, size in groups.items():
+            if size < TABLE_MIN_RECORDS:
+                continue
+            key = key if isinstance(key, tuple) else (key,)
+            fixed = dict(zip(names, key))
+            for i_m in imts:
+                if any(table.params == fixed for table in tables.get(gmpe_name, i_m)):
+                    continue
+                try:
+                    tables.add(trpl.GMPETable.build(gmpe_name, i_m, table_magnitudes, TABLE_DISTANCES,
+                                                    TABLE_VS30S, fixed))
+                    added += 1
+                except KeyError:
+                    # The GMPE does not define the IMT
+                    pass
+    if added:
+        tables.to_npz(file_name)
+    error = max([table.errors.get('mean', 0.0) for table in tables], default=0.0)
+    return tables, error
+
+
+# Predicted value of each GMPE at every recording, in one batched evaluation,
+# with the ln-residuals of the recorded values and the GMPE ranking, one row
+# per event/station/IMT
+def residual_table(data, gmpe_list, imts, tables=None):
+    import pandas as pd
+    import smtk.trellis.trellis_plots as trpl
+    gmvs = trpl.evaluate_records(gmpe_list, imts, *record_inputs(data), tables=tables)
+    imt_tables = []
+    for i_m in imts:
+        column = RECORDED_COLUMNS.get(i_m, i_m.lower())
+        recorded = data[column].to_numpy(dtype=float) if column in data else np.full(len(data), np.nan)
+        # GMPEs not defined for the IMT predict NaN
+        predicted = np.column_stack([gmvs[gmpe][i_m] if len(gmvs[gmpe][i_m]) else np.full(len(data), np.nan)
+                                     for gmpe in gmpe_list])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            residuals = np.log(recorded)[:, None] - np.log(predicted)
+        misfit = np.abs(residuals)
+        table = pd.DataFrame({"eq_event_id": data['eq_event_id'].to_numpy(),
+                              "station": data['station'].to_numpy(),
+                              "magnitude": data['magnitude'].to_numpy(),
+                              "imt": i_m,
+                              "recorded": recorded}, index=data.index)
+        table = pd.concat([
+            table,
+            pd.DataFrame(predicted, index=data.index, columns=gmpe_list),
+            pd.DataFrame(residuals, index=data.index, columns=[f"{gmpe}_ln_residual" for gmpe in gmpe_list]),
+            # 1 is the GMPE closest to the recording (smallest |ln-residual|)
+            pd.DataFrame(misfit, index=data.index, columns=[f"{gmpe}_rank" for gmpe in gmpe_list]).rank(
+                axis=1, method='min')], axis=1)
+        names = np.array(gmpe_list, dtype=object)
+        table["closest_gmpe"] = np.where(np.isnan(misfit).all(axis=1), None,
+                                         names[np.argmin(np.nan_to_num(misfit, nan=np.inf), axis=1)])
+        table["highest_gmpe"] = np.where(np.isnan(predicted).all(axis=1), None,
+                                         names[np.argmax(np.nan_to_num(predicted, nan=-np.inf), axis=1)])
+        imt_tables.append(table)
+    # Group the IMTs of each recording together, in input order
+    return pd.concat(imt_tables).sort_index(kind='stable').reset_index(drop=True)
+
+
+# Writes the residual table as CSV and, when pyarrow is installed, Parquet;
+# returns the files written
+def write_residual_table(table, base_folder):
+    base_name = os.path.join(base_folder, f"{os.path.basename(base_folder)}_residuals")
+    table.to_csv(f"{base_name}.csv", index=False)
+    files = [f"{base_name}.csv"]
     try:
+        table.to_parquet(f"{base_name}.parquet", index=False)
+        files.append(f"{base_name}.parquet")
+    except ImportError:
+        pass
+    return files
+
+
+# Processes one recordings CSV and returns a status message. progress(done,
+# total, text) is called after each row and cancelled() is checked between
+# rows; both are called on the processing thread. plot_settings overrides the
+# dpi and format of each plot type (see smtk_render.PLOT_SETTINGS)
+def process_data(file_path, year, process_type="PGA", table_only=False, sweep=True,
+                 use_tables=False, plot_settings=None, progress=None, cancelled=None):
+    renderer = None
+    try:
+        import pandas as pd
+        import seaborn as sns
+        import smtk.trellis.trellis_plots as trpl
+        import smtk.trellis.trellis_utils as trellis_utils
+
         data = pd.read_csv(file_path)
         
         # Get the directory of the input CSV file
@@ -78,12 +285,8 @@ def process_data(file_path, year):
         base_folder = os.path.join(csv_directory, get_base_name(file_path))
         create_directories(base_folder)
         
-        global selected_process  # Make sure to declare the global variable
-        process_type = selected_process.get()  # Retrieve the selected value (PGA or SA)
-        
-        
-        # Set up the configuration
-        GMPES = get_available_gsims()
+
+        # Set up the configuration (the GSIMs are resolved by name when used)
         gmpe_list = [
                 "AbrahamsonEtAl2014",
                 "BooreAtkinson2008",
@@ -144,6 +347,24 @@ def process_data(file_path, year):
             gmpe_list = gmpe_list
             imts = ["PGA"] 
 
+        # Interpolated GMPE values where the lookup tables cover the
+        # recordings, direct evaluation elsewhere
+        tables = None
+        table_text = ""
+        if use_tables:
+            if progress is not None:
+                progress(0, len(data), "Building GMPE lookup tables")
+            tables, table_error = gmpe_tables(data, gmpe_list, imts, magnitudes, csv_directory)
+            table_text = f", {len(tables)} lookup tables (max ln-median error {table_error:.3f})"
+
+        if table_only:
+            # Numbers only: every row evaluated at once, no figures
+            files = write_residual_table(residual_table(data, gmpe_list, imts, tables), base_folder)
+            if use_tables:
+                table_text += (f", {tables.served()} of {len(data) * len(gmpe_list) * len(imts)} "
+                               f"record values interpolated")
+            return f"Done ({len(data)} rows{table_text}), saved {', '.join(files)}"
+
         # Define the markers for each GMPE
         gmpe_styles = {
             "AbrahamsonEtAl2014": {"marker": "o"},
@@ -170,8 +391,22 @@ def process_data(file_path, year):
         # Combine markers and colors into a dictionary
         marker_colors = dict(zip(markers, palette))
 
+        # Rows sharing a scenario reuse its trellises and ground motions
+        scenarios = ScenarioCache(gmpe_list, imts, magnitudes, tables)
+
+        # Figures are rendered off-screen in parallel worker processes
+        renderer = smtk_render.RenderPool(settings=plot_settings)
+
+        # Each GMPE at the exact magnitude, distances and site of every
+        # recording, in one batched evaluation
+        point_gmvs = trpl.evaluate_records(gmpe_list, ["PGA"], *record_inputs(data), tables=tables)
+        if use_tables:
+            table_text += f", {tables.served()} of {len(data) * len(gmpe_list)} record values interpolated"
+
         # Iterate through each row in the CSV and generate plots
-        for index, row in data.iterrows():
+        for iloc, (index, row) in enumerate(data.iterrows()):
+            if cancelled is not None and cancelled():
+                return f"Cancelled after {iloc} of {len(data)} rows"
             # Extract the necessary values from the row
             magnitude = row['magnitude']
             pga = row['pga']
@@ -188,74 +423,30 @@ def process_data(file_path, year):
                 "z2pt5": row['z2pt5']
             }
             
-            # Plotting
-            mag_plot = trpl.MagnitudeIMTTrellis(magnitudes, distances, gmpe_list, imts, params, dpi=400, figure_size=(20, 15))
-            
-            # mag_plot.export_to_csv("output.csv")
-            
-            plt.figure()
-                
-            mag_plot.plot()
-            
-            # dis_plot = trpl.DistanceIMTTrellis(magnitude, distances1, gmpe_list, imts, params, distance_type='rjb', plot_type='loglog', dpi=400, figure_size=(20, 15))
-            
-            rupt1 = rcfg.GSIMRupture(magnitude=magnitude,   # Moment magnitude
-                                dip=params['dip'],   # Dip of Rupture
-                                aspect=1.5, # Aspect Ratio of Rupture
-                                rake=params['rake'],  # Rake of rupture 
-                                ztor=params['ztor'],  # Top of rupture depth
-                                # strike=0.0,  # Strike of rupture
-                                # hypocentre_location=hypo_loc   # Location of hypocentre within rupture plane
-                                )
-            # It is critical that before running the trellis plots, the site configuration must be run!!!!
-            _ = rupt1.get_target_sites_line(200.0, 1.0, params['vs30'])
-            # rupt1.plot_model_configuration()
-            
-            dis_plot = trpl.DistanceIMTTrellis.from_rupture_model(rupt1, gmpe_list, imts, dpi=400, figure_size=(20, 15))
-
-            
-            # Find the nearest index for the specified magnitude
-            nearest_idx = np.searchsorted(magnitudes, magnitude, side="left")
+            # The distance trellis only depends on the rupture and vs30
+            dis_plot = scenarios.distance_trellis(magnitude, params)
 
-            # Retrieve and plot the PGA values for each GMPE at the nearest magnitude
-            gmvs = mag_plot.get_ground_motion_values()
-            
-            # List to collect legend handles and labels
-            legend_handles_labels = []
+            # Markers of the GMPE values at the recorded magnitude
+            points = []
             
             # List to collect bar heights and labels
             bar_heights = []
             bar_labels = []
             
             for gmpe_name in gmpe_list:
-                if nearest_idx < len(magnitudes) and magnitudes[nearest_idx] == magnitude:
-                    # Assume the GMVs are arrays, take the mean value
-                    pga_value = np.mean(gmvs[gmpe_name]['PGA'][nearest_idx])
-                else:
-                    # Handle the case where the exact magnitude is not in the range
-                    if nearest_idx == 0 or nearest_idx == len(magnitudes):
-                        # Take the mean value for the first or last set of GMVs
-                        pga_value = np.mean(gmvs[gmpe_name]['PGA'][nearest_idx])
-                    else:
-                        # Interpolate between the two nearest sets of GMVs
-                        pga_values_below = np.mean(gmvs[gmpe_name]['PGA'][nearest_idx - 1])
-                        pga_values_above = np.mean(gmvs[gmpe_name]['PGA'][nearest_idx])
-                        pga_value = np.interp(magnitude,
-                                            [magnitudes[nearest_idx - 1], magnitudes[nearest_idx]],
-                                            [pga_values_below, pga_values_above])
-                        
+                # PGA of the GMPE at the recorded magnitude (NaN if the
+                # recordings lack a parameter the GMPE requires)
+                gmpe_pgas = point_gmvs[gmpe_name]['PGA']
+                pga_value = gmpe_pgas[iloc] if len(gmpe_pgas) else np.nan
+
                 # Append the PGA value to the list for bar graph
                 bar_heights.append(pga_value)
                 bar_labels.append(f"{gmpe_name}: {pga_value:.3f}")
 
-
                 # Plot the PGA value with a distinct marker and color
                 style = gmpe_styles.get(gmpe_name, {"marker": "o"})  # Default style if GMPE not in dict
                 color = marker_colors.get(style["marker"], "black")  # Use Seaborn color if marker is in the palette
-                plot_handle, = plt.plot(magnitude, pga_value, style['marker'], color=color, markersize=12, label=f"{gmpe_name}: {pga_value:.3f}" if index == 0 else "")
-
-                # Append the handle and label to the list
-                legend_handles_labels.append((plot_handle, f"{gmpe_name}: {pga_value:.3f}"))
+                points.append((f"{gmpe_name}: {pga_value:.3f}", pga_value, style['marker'], color))
 
             # Store the PGA value in the dictionary
             pga_data[gmpe_name].append(pga_value)
@@ -274,114 +465,138 @@ def process_data(file_path, year):
                 "rx": ensure_single_value(row['rx']),
                 "ry0": ensure_single_value(row['ry0'])
             }
-            
-            plt.axvline(x=magnitude, color='gray', linestyle='--', linewidth=2, alpha=0.5)
-            #plt.text(magnitude - 0.3, pga, create_label(2023, magnitude, pga, distances), fontsize=12, bbox=dict(facecolor='white', alpha=0.5))
-            #plt.plot(magnitude, pga, '*', markersize=15, color='yellow')
-            
-            # Add legend entry with yellow star marker and text label
-            legend_label = create_label(year, magnitude, pga, distances)
-            star_handle, = plt.plot(magnitude, pga, '*', markersize=15, color='#DB4437', label=legend_label)
-            legend_handles_labels.append((star_handle, legend_label))
-            
 
-            # Customizing the aesthetics of the plot
-            plt.title(f"{row['eq_event_id']} - {row['station']}, {magnitude}", fontsize=20)
-            plt.xlabel('Magnitude', fontsize=16)
-            plt.ylabel('PGA (g)', fontsize=16)
-            
-            # Add legend entry with yellow star marker and text label
-            plt.legend(handles=[handle for handle, _ in legend_handles_labels],
-                    labels=[label for _, label in legend_handles_labels], bbox_to_anchor=(1, 1), fontsize=14, frameon=False)
-            
-            
-            plt.xticks(fontsize=14)
-            plt.yticks(fontsize=14)
-            
-            file_name = f"plot_{row['eq_event_id']}_{row['station']}_PGA.png"
-            file_name = file_name.replace(' ', '_').replace(',', '_').replace('/', '_')
-            
-            # plt.savefig(file_name)
-            
-            # plt.show()
-            mag_plot_file = os.path.join(base_folder, 'magnitude_comparison', file_name)
-            plt.savefig(mag_plot_file)
-            plt.clf()
-            
-            ########################################################################################
-            
-            plt.figure()
-
-            dis_plot.plot()
-            
-            # Customizing the aesthetics of the plot
-            plt.title(f"{row['eq_event_id']} - {row['station']}, {magnitude}", fontsize=20)
-            
-            plt.legend(bbox_to_anchor=(1, 1), fontsize=14, frameon=False)
-            
-            # Save dis_plot
-            dis_plot_file_name = f"dis_plot_{row['eq_event_id']}_{row['station']}_PGA.png"
-            dis_plot_file_name = dis_plot_file_name.replace(' ', '_').replace(',', '_').replace('/', '_')
-            # plt.savefig(dis_plot_file_name)
-            
-            dis_plot_file = os.path.join(base_folder, 'distance_analysis', dis_plot_file_name)
-            plt.savefig(dis_plot_file)
-            plt.clf()
-            
-            ######################################################################################
-            
-            # Convert bar_heights to a NumPy array
-            bar_heights_np = np.array(bar_heights)
-
-            # Find the index of the highest PGA value
-            max_index = np.argmax(bar_heights_np)
-
-            # Find the index of the closest PGA value
-            closest_index = np.nanargmin(np.abs(bar_heights_np - row['pga']))
-
-            # Plot the bar graph using Seaborn colors
-            plt.bar(np.arange(len(gmpe_list)), bar_heights, tick_label=bar_labels, color='gray')
-            plt.bar(max_index, bar_heights[max_index], color='#DB4437', label=f'Highest PGA: {bar_labels[max_index]}')
-
-            if not np.isnan(row['pga']):
-                plt.bar(closest_index, bar_heights[closest_index], color='#4285F4', label=f'Closest PGA: {bar_labels[closest_index]}')
-
-                # Add a horizontal line for the recorded PGA value
-                plt.axhline(y=row['pga'], color='#F4B400', linestyle='--', label=f'Recorded PGA: {row["pga"]:.3f}')  
-
-            # Customizing the aesthetics of the bar graph
-            plt.title(f"{row['eq_event_id']} - {row['station']}, {magnitude}", fontsize=20)
-            plt.xlabel('GMPE', fontsize=16)
-            plt.ylabel('PGA (g)', fontsize=16)
-
-            # Rotate x-axis labels to 45 degrees for better readability
-            plt.xticks(rotation=45, ha='right', fontsize=14)
-
-            # Add legend entry with yellow star marker and text label
-            plt.legend(loc='upper left', bbox_to_anchor=(1, 1), fontsize=14, ncol=1, frameon=False)
-
-            plt.yticks(fontsize=14)
-
-            file_name = f"bar_plot_{row['eq_event_id']}_{row['station']}_PGA.png"
+            title = f"{row['eq_event_id']} - {row['station']}, {magnitude}"
+            file_name = f"{row['eq_event_id']}_{row['station']}_PGA"
             file_name = file_name.replace(' ', '_').replace(',', '_').replace('/', '_')
 
-            plt.tight_layout()  # Adjust layout to prevent clipping of the legend
-            # plt.savefig(file_name)
-
-            # plt.show()
-            
-            bar_plot_file = os.path.join(base_folder, '  ', file_name)
-            plt.savefig(bar_plot_file)
-            plt.clf()
-
-        status_label.configure(text="Status: Done")
-    except Exception as e:
-        messagebox.showerror("Error", f"An error occurred: {e}")
+            # The figures are drawn and saved by the render workers. The
+            # magnitude sweep is only evaluated when its plot is requested
+            if sweep:
+                mag_plot = scenarios.magnitude_trellis(distances, params)
+                renderer.submit('magnitude', os.path.join(base_folder, 'magnitude_comparison', f"plot_{file_name}"),
+                                figure_size=mag_plot.figure_size,
+                                grid=trellis_utils.best_subplot_dimensions(len(imts)),
+                                magnitudes=magnitudes,
+                                panels=smtk_render.trellis_panels(mag_plot, 'magnitude'),
+                                xlim=(floor(magnitudes[0]), ceil(magnitudes[-1])),
+                                title=title, magnitude=magnitude, points=points,
+                                recorded=pga, recorded_label=create_label(year, magnitude, pga, distances),
+                                ylabel='PGA (g)')
+
+            renderer.submit('distance', os.path.join(base_folder, 'distance_analysis', f"dis_plot_{file_name}"),
+                            figure_size=dis_plot.figure_size,
+                            grid=trellis_utils.best_subplot_dimensions(len(imts)),
+                            distances=dis_plot.distances[dis_plot.distance_type],
+                            panels=smtk_render.trellis_panels(dis_plot, 'distance'),
+                            xlabel="%s (km)" % trpl.DISTANCE_LABEL_MAP[dis_plot.distance_type],
+                            title=title, plot_type=dis_plot.plot_type)
+
+            renderer.submit('bar', os.path.join(base_folder, 'pga_analysis', f"bar_plot_{file_name}"),
+                            heights=bar_heights, labels=bar_labels, recorded=row['pga'],
+                            title=title, ylabel='PGA (g)')
+
+            if progress is not None:
+                progress(iloc + 1, len(data), f"{row['eq_event_id']} - {row['station']}")
+
+        # Wait for the last figures
+        renderer.join()
+
+        return f"Done ({len(data)} rows, {len(scenarios)} scenarios evaluated{table_text})"
+    finally:
+        if renderer is not None:
+            renderer.close(cancel=True)
+
+
+class ProcessingQueue:
+    """
+    Runs process_data for queued CSV files one after another on a background
+    thread, so the window stays responsive. The Tk thread polls progress()
+    and results() through root.after; cancel() stops the current file
+    between rows and drops the files queued so far.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.cancelled_upto = 0
+        self.queued = 0
+        self.status = None
+        self.messages = queue.Queue()
+
+    def submit(self, file_path, year, **options):
+        with self.lock:
+            self.submitted += 1
+            self.queued += 1
+            job = self.submitted
+        self.executor.submit(self._run, job, file_path, year, options)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled_upto = self.submitted
+
+    def busy(self):
+        return self.queued > 0
+
+    def _run(self, job, file_path, year, options):
+        name = os.path.basename(file_path)
+        start_time = time.time()
+
+        def cancelled():
+            return job <= self.cancelled_upto
+
+        def progress(done, total, current):
+            elapsed = time.time() - start_time
+            eta = elapsed / done * (total - done) if done else None
+            self.status = (name, done, total, eta, current)
+
+        try:
+            if cancelled():
+                self.messages.put(('info', name, "Cancelled"))
+                return
+            self.status = (name, 0, None, None, "Loading")
+            message = process_data(file_path, year, progress=progress, cancelled=cancelled, **options)
+            self.messages.put(('info', name, message))
+        except Exception as e:
+            self.messages.put(('error', name, f"An error occurred: {e}"))
+        finally:
+            with self.lock:
+                self.queued -= 1
+                self.status = None
+
+    # Progress of the current file as text, None when idle
+    def progress(self):
+        status = self.status
+        if status is None:
+            return None
+        name, done, total, eta, current = status
+        text = f"Status: Processing {name}"
+        if total:
+            text += f": row {done}/{total}"
+            if eta is not None:
+                text += f", ETA {int(eta // 60)}m{int(eta % 60):02d}s"
+        text += f" ({current})"
+        waiting = self.queued - 1
+        if waiting > 0:
+            text += f", {waiting} more file(s) queued"
+        return text
+
+    # Messages of the finished files since the last call
+    def results(self):
+        while True:
+            try:
+                yield self.messages.get_nowait()
+            except queue.Empty:
+                return
 
 def browse_file():
-    global pga_radio, sa_radio
-    file_path = filedialog.askopenfilename(filetypes=[("CSV Files", "*.csv")])
-    if file_path:
+    global pga_radio, sa_radio, selected_files
+    # Several files can be selected; they are processed one after another
+    selected_files = list(filedialog.askopenfilenames(filetypes=[("CSV Files", "*.csv")]))
+    if selected_files:
+        file_path = selected_files[0]
+        if len(selected_files) > 1:
+            file_path += f" (+{len(selected_files) - 1} more)"
         file_path_label.configure(text=file_path)
         process_button.configure(state="normal")
         pga_radio.configure(state="normal")  # Enable radio buttons if a file is selected
@@ -393,82 +608,155 @@ def browse_file():
         sa_radio.configure(state="disabled")
 
 def on_process_click():
-    file_path = file_path_label.cget("text")
     year = year_entry.get()
     if not year.isdigit():
         messagebox.showerror("Error", "Invalid year. Please enter a valid year.")
         return
+    # Resolution and file format of each plot type
+    plot_settings = {}
+    for kind, (dpi_entry, format_var) in plot_setting_widgets.items():
+        dpi = dpi_entry.get()
+        if not dpi.isdigit() or int(dpi) == 0:
+            messagebox.showerror("Error", f"Invalid DPI for the {kind} plots.")
+            return
+        plot_settings[kind] = {'dpi': int(dpi), 'format': format_var.get()}
+    # The options are read here, on the Tk thread
+    for file_path in selected_files:
+        processing.submit(file_path, year, process_type=selected_process.get(),
+                          table_only=table_only_var.get(), sweep=sweep_var.get(),
+                          use_tables=tables_var.get(), plot_settings=plot_settings)
     status_label.configure(text="Status: Processing...")
-    root.update_idletasks()
-    process_data(file_path, year)
-
-## Create the main window
-root = customtkinter.CTk()
-root.title("SMTK GMPE Analysis")
-root.geometry("700x200")  # Adjust the size as needed
-
-# Set default window size and start position (center screen)
-window_width = 800
-window_height = 300
-screen_width = root.winfo_screenwidth()
-screen_height = root.winfo_screenheight()
-center_x = int(screen_width/2 - window_width / 2)
-center_y = int(screen_height/2 - window_height / 2)
-root.geometry(f'{window_width}x{window_height}+{center_x}+{center_y}')
-
-# Styling Variables
-font_style = "Arial"
-font_size = 12
-padding = 10
-font_tuple = (font_style, font_size)
-
-# Initialize the global variable after creating the root window
-selected_process = tk.StringVar(value="PGA")
-
-# # Create a Frame for input widgets
-# input_frame = tk.Frame(root)
-# input_frame.pack(padx=10, pady=10)
-
-# Create a Frame for input widgets
-input_frame = customtkinter.CTkFrame(root, fg_color="transparent")
-input_frame.pack(padx=20, pady=20)
-
-# # Create widgets inside input_frame
-# file_path_label = tk.Label(input_frame, text="No file selected", font=(font_style, font_size))
-# browse_button = tk.Button(input_frame, text="Browse CSV", command=browse_file, font=(font_style, font_size))
-# # Create a label for the year input
-# year_label = tk.Label(input_frame, text="Enter Year:", font=(font_style, font_size))
-# year_entry = tk.Entry(input_frame, font=(font_style, font_size))
-# process_button = tk.Button(input_frame, text="Process Data", command=on_process_click, state="disabled", font=(font_style, font_size))
-# status_label = tk.Label(input_frame, text="Status: Idle", font=(font_style, font_size))
-
-# Create widgets inside input_frame
-file_path_label = customtkinter.CTkLabel(input_frame, text="No file selected", font=font_tuple)
-browse_button = customtkinter.CTkButton(input_frame, text="Browse CSV", command=browse_file, font=font_tuple)
-# Create a label for the year input
-year_label = customtkinter.CTkLabel(input_frame, text="Enter Year:", font=font_tuple)
-year_entry = customtkinter.CTkEntry(input_frame, font=font_tuple)
-process_button = customtkinter.CTkButton(input_frame, text="Process Data", command=on_process_click, state="disabled", font=font_tuple)
-status_label = customtkinter.CTkLabel(input_frame, text="Status: Idle", font=font_tuple)
-
-# Create radio buttons
-create_radio_buttons(input_frame)
-
-# # Layout the widgets using grid
-# file_path_label.grid(row=0, column=0, sticky="w", pady=padding)
-# browse_button.grid(row=0, column=1, sticky="e", padx=padding)
-# year_label.grid(row=1, column=0, sticky="w")  # Align the new label to the left
-# year_entry.grid(row=1, column=1, sticky="ew", pady=padding)  # Place the year entry next to the label
-# process_button.grid(row=3, column=0, columnspan=2, sticky="ew", pady=padding)
-# status_label.grid(row=4, column=0, columnspan=2, sticky="ew", pady=padding)
-
-# Layout the widgets using grid
-file_path_label.grid(row=0, column=0, sticky="w", pady=padding)
-browse_button.grid(row=0, column=1, sticky="e", padx=padding)
-year_label.grid(row=1, column=0, sticky="w")
-year_entry.grid(row=1, column=1, sticky="ew", pady=padding)
-process_button.grid(row=3, column=0, columnspan=2, sticky="ew", pady=padding)
-status_label.grid(row=4, column=0, columnspan=2, sticky="ew", pady=padding)
-
-# Start the application
-root.mainloop()
\ No newline at end of file
+    if not polling:
+        poll_processing()
+
+def on_cancel_click():
+    processing.cancel()
+    status_label.configure(text="Status: Cancelling...")
+
+def show_results():
+    for kind, name, message in processing.results():
+        if kind == 'error':
+            messagebox.showerror("Error", f"{name}: {message}")
+        else:
+            status_label.configure(text=f"Status: {name}: {message}")
+
+def poll_processing():
+    global polling
+    # Checked before the results: a finished queue has posted all of them
+    polling = processing.busy()
+    show_results()
+    text = processing.progress()
+    if text:
+        status_label.configure(text=text)
+    if polling:
+        root.after(200, poll_processing)
+
+selected_files = []  # CSV files picked in the file dialog
+processing = ProcessingQueue()  # Background processing of the queued files
+polling = False  # Whether poll_processing is scheduled
+
+# The GUI is only built when run as a script: the render worker processes
+# may re-import this module and must not open a window
+if __name__ == "__main__":
+    ## Create the main window
+    root = customtkinter.CTk()
+    root.title("SMTK GMPE Analysis")
+    root.geometry("700x200")  # Adjust the size as needed
+
+    # Set default window size and start position (center screen)
+    window_width = 800
+    window_height = 480
+    screen_width = root.winfo_screenwidth()
+    screen_height = root.winfo_screenheight()
+    center_x = int(screen_width/2 - window_width / 2)
+    center_y = int(screen_height/2 - window_height / 2)
+    root.geometry(f'{window_width}x{window_height}+{center_x}+{center_y}')
+
+    # Styling Variables
+    font_style = "Arial"
+    font_size = 12
+    padding = 10
+    font_tuple = (font_style, font_size)
+
+    # Initialize the global variable after creating the root window
+    selected_process = tk.StringVar(value="PGA")
+
+    # # Create a Frame for input widgets
+    # input_frame = tk.Frame(root)
+    # input_frame.pack(padx=10, pady=10)
+
+    # Create a Frame for input widgets
+    input_frame = customtkinter.CTkFrame(root, fg_color="transparent")
+    input_frame.pack(padx=20, pady=20)
+
+    # # Create widgets inside input_frame
+    # file_path_label = tk.Label(input_frame, text="No file selected", font=(font_style, font_size))
+    # browse_button = tk.Button(input_frame, text="Browse CSV", command=browse_file, font=(font_style, font_size))
+    # # Create a label for the year input
+    # year_label = tk.Label(input_frame, text="Enter Year:", font=(font_style, font_size))
+    # year_entry = tk.Entry(input_frame, font=(font_style, font_size))
+    # process_button = tk.Button(input_frame, text="Process Data", command=on_process_click, state="disabled", font=(font_style, font_size))
+    # status_label = tk.Label(input_frame, text="Status: Idle", font=(font_style, font_size))
+
+    # Create widgets inside input_frame
+    file_path_label = customtkinter.CTkLabel(input_frame, text="No file selected", font=font_tuple)
+    browse_button = customtkinter.CTkButton(input_frame, text="Browse CSV", command=browse_file, font=font_tuple)
+    # Create a label for the year input
+    year_label = customtkinter.CTkLabel(input_frame, text="Enter Year:", font=font_tuple)
+    year_entry = customtkinter.CTkEntry(input_frame, font=font_tuple)
+    process_button = customtkinter.CTkButton(input_frame, text="Process Data", command=on_process_click, state="disabled", font=font_tuple)
+    cancel_button = customtkinter.CTkButton(input_frame, text="Cancel", command=on_cancel_click, font=font_tuple)
+    status_label = customtkinter.CTkLabel(input_frame, text="Status: Idle", font=font_tuple)
+
+    # Create radio buttons
+    create_radio_buttons(input_frame)
+
+    # Skip the figures and only write the residual table
+    table_only_var = tk.BooleanVar(value=False)
+    table_only_check = customtkinter.CTkCheckBox(input_frame, text="Residual table only (no plots)", variable=table_only_var, font=font_tuple)
+
+    # The magnitude sweep (4.0-7.0) is only evaluated for its plot
+    sweep_var = tk.BooleanVar(value=True)
+    sweep_check = customtkinter.CTkCheckBox(input_frame, text="Magnitude sweep plots", variable=sweep_var, font=font_tuple)
+
+    # Interpolate the GMPEs from precomputed tables (saved next to the CSV)
+    tables_var = tk.BooleanVar(value=False)
+    tables_check = customtkinter.CTkCheckBox(input_frame, text="GMPE lookup tables (approximate)", variable=tables_var, font=font_tuple)
+
+    # DPI and file format of each plot type, one row per type
+    plot_frame = customtkinter.CTkFrame(input_frame, fg_color="transparent")
+    plot_setting_widgets = {}
+    for plot_row, (kind, settings) in enumerate(smtk_render.PLOT_SETTINGS.items()):
+        customtkinter.CTkLabel(plot_frame, text=f"{kind.capitalize()} plots DPI:", font=font_tuple).grid(
+            row=plot_row, column=0, sticky="w", padx=padding)
+        dpi_entry = customtkinter.CTkEntry(plot_frame, width=70, font=font_tuple)
+        dpi_entry.insert(0, str(settings['dpi']))
+        dpi_entry.grid(row=plot_row, column=1, padx=padding, pady=2)
+        format_var = tk.StringVar(value=settings['format'])
+        customtkinter.CTkOptionMenu(plot_frame, values=smtk_render.PLOT_FORMATS, variable=format_var,
+                                    width=90, font=font_tuple).grid(row=plot_row, column=2, pady=2)
+        plot_setting_widgets[kind] = (dpi_entry, format_var)
+
+    # # Layout the widgets using grid
+    # file_path_label.grid(row=0, column=0, sticky="w", pady=padding)
+    # browse_button.grid(row=0, column=1, sticky="e", padx=padding)
+    # year_label.grid(row=1, column=0, sticky="w")  # Align the new label to the left
+    # year_entry.grid(row=1, column=1, sticky="ew", pady=padding)  # Place the year entry next to the label
+    # process_button.grid(row=3, column=0, columnspan=2, sticky="ew", pady=padding)
+    # status_label.grid(row=4, column=0, columnspan=2, sticky="ew", pady=padding)
+
+    # Layout the widgets using grid
+    file_path_label.grid(row=0, column=0, sticky="w", pady=padding)
+    browse_button.grid(row=0, column=1, sticky="e", padx=padding)
+    year_label.grid(row=1, column=0, sticky="w")
+    year_entry.grid(row=1, column=1, sticky="ew", pady=padding)
+    table_only_check.grid(row=3, column=0, sticky="w", pady=padding)
+    sweep_check.grid(row=3, column=1, sticky="w", pady=padding)
+    tables_check.grid(row=4, column=0, sticky="w", pady=padding)
+    plot_frame.grid(row=5, column=0, columnspan=2, sticky="w", pady=padding)
+    process_button.grid(row=6, column=0, sticky="ew", pady=padding)
+    cancel_button.grid(row=6, column=1, sticky="ew", padx=padding, pady=padding)
+    status_label.grid(row=7, column=0, columnspan=2, sticky="ew", pady=padding)
+
+    # Start the application
+    root.mainloop()
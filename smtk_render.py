@@ -0,0 +1,241 @@
+"""
+Off-screen rendering of the smtk-app.py figures. The app computes the ground
+motions and passes plain data (arrays, labels, colours) to a pool of worker
+processes that draw each figure on its own Agg canvas, save it and release
+it, so drawing runs in parallel with the computation and memory does not
+grow with the number of rows:
+
+    with RenderPool() as pool:
+        pool.submit('bar', 'out/pga_analysis/bar_plot_x', **bar_data)
+
+No pyplot state is used: every figure is a standalone matplotlib Figure.
+"""
+import os
+import warnings
+from concurrent.futures import (ProcessPoolExecutor, ALL_COMPLETED, FIRST_COMPLETED,
+                                wait)
+
+import numpy as np
+
+# Default resolution and file format of each plot type
+PLOT_SETTINGS = {
+    'magnitude': {'dpi': 100, 'format': 'png'},
+    'distance': {'dpi': 100, 'format': 'png'},
+    'bar': {'dpi': 100, 'format': 'png'},
+}
+
+# File formats offered for the figures
+PLOT_FORMATS = ['png', 'pdf', 'svg', 'jpg']
+
+# Pending figures per worker before submit waits for one to finish
+QUEUE_DEPTH = 4
+
+# Style settings that only make sense in the parent process
+_PROCESS_RC = ('backend', 'backend_fallback', 'interactive')
+
+
+# Style of the calling process (seaborn theme, trellis colour cycle, font
+# sizes) so that the workers draw exactly what pyplot would have drawn
+def current_style():
+    import matplotlib
+    return {key: value for key, value in matplotlib.rcParams.items()
+            if key not in _PROCESS_RC}
+
+
+def _init_worker(style):
+    import matplotlib
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        matplotlib.rcParams.update(style)
+
+
+def _new_figure():
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig
+
+
+# Trellis panels of the ground motion values of a trellis: one panel per IMT
+# with a curve per GMPE, taken along the magnitudes (axis 'magnitude', first
+# site) or along the sites (axis 'distance', first magnitude)
+def trellis_panels(trellis, axis):
+    gmvs = trellis.get_ground_motion_values()
+    panels = []
+    for i_m in trellis.imts:
+        curves = {}
+        for gmpe_name in trellis.gsims:
+            values = gmvs[gmpe_name][i_m]
+            if len(values):
+                curves[gmpe_name] = values[:, 0] if axis == 'magnitude' else values[0, :]
+        panels.append({'imt': i_m, 'ylabel': trellis._get_ylabel(i_m), 'curves': curves})
+    return panels
+
+
+def _panel_axes(fig, grid, count):
+    nrow, ncol = grid
+    return [fig.add_subplot(nrow, ncol, i + 1) for i in range(count)]
+
+
+# Magnitude trellis with the GMPE values at the recorded magnitude, the
+# recorded value and a legend of both on the last panel
+def render_magnitude(fig, figure_size, grid, magnitudes, panels, xlim, title,
+                     magnitude, points, recorded, recorded_label, ylabel):
+    fig.set_size_inches(figure_size)
+    fig.set_tight_layout(True)
+    axes = _panel_axes(fig, grid, len(panels))
+    for ax, panel in zip(axes, panels):
+        for gmpe_name, values in panel['curves'].items():
+            ax.semilogy(magnitudes, values, linewidth=2.0, label=gmpe_name)
+        ax.grid(True)
+        ax.set_xlim(*xlim)
+        ax.set_xlabel("Magnitude", fontsize=16)
+        ax.set_ylabel(panel['ylabel'], fontsize=16)
+    ax = axes[-1]
+    handles = []
+    for label, value, marker, color in points:
+        handle, = ax.plot(magnitude, value, marker, color=color, markersize=12)
+        handles.append((handle, label))
+    ax.axvline(x=magnitude, color='gray', linestyle='--', linewidth=2, alpha=0.5)
+    star, = ax.plot(magnitude, recorded, '*', markersize=15, color='#DB4437')
+    handles.append((star, recorded_label))
+    ax.set_title(title, fontsize=20)
+    ax.set_xlabel('Magnitude', fontsize=16)
+    ax.set_ylabel(ylabel, fontsize=16)
+    ax.legend(handles=[handle for handle, _ in handles],
+              labels=[label for _, label in handles],
+              bbox_to_anchor=(1, 1), fontsize=14, frameon=False)
+    ax.tick_params(labelsize=14)
+
+
+# Distance trellis: median of each GMPE against distance, one panel per IMT
+def render_distance(fig, figure_size, grid, distances, panels, xlabel, title,
+                    plot_type='loglog'):
+    fig.set_size_inches(figure_size)
+    fig.set_tight_layout(True)
+    axes = _panel_axes(fig, grid, len(panels))
+    for ax, panel in zip(axes, panels):
+        for gmpe_name, values in panel['curves'].items():
+            if plot_type == "semilogy":
+                ax.semilogy(distances, values, linewidth=2.0, label=gmpe_name)
+                ax.set_xlim(distances[0], distances[-1])
+            else:
+                ax.loglog(distances, values, linewidth=2.0, label=gmpe_name)
+                ax.set_xlim(0.5, distances[-1])
+        ax.grid(True)
+        ax.set_xlabel(xlabel, fontsize=16)
+        ax.set_ylabel(panel['ylabel'], fontsize=16)
+    axes[-1].set_title(title, fontsize=20)
+    axes[-1].legend(bbox_to_anchor=(1, 1), fontsize=14, frameon=False)
+
+
+# Bar chart of the GMPE values, highlighting the highest one and, when there
+# is a recording, the one closest to it
+def render_bar(fig, heights, labels, recorded, title, ylabel):
+    heights = np.asarray(heights, dtype=float)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.bar(np.arange(len(heights)), heights, tick_label=labels, color='gray')
+    # No highlights when no GMPE could be evaluated
+    evaluated = not np.all(np.isnan(heights))
+    if evaluated:
+        max_index = np.nanargmax(heights)
+        ax.bar(max_index, heights[max_index], color='#DB4437',
+               label=f'Highest PGA: {labels[max_index]}')
+    if not np.isnan(recorded):
+        if evaluated:
+            closest_index = np.nanargmin(np.abs(heights - recorded))
+            ax.bar(closest_index, heights[closest_index], color='#4285F4',
+                   label=f'Closest PGA: {labels[closest_index]}')
+        # Horizontal line for the recorded value
+        ax.axhline(y=recorded, color='#F4B400', linestyle='--',
+                   label=f'Recorded PGA: {recorded:.3f}')
+    ax.set_title(title, fontsize=20)
+    ax.set_xlabel('GMPE', fontsize=16)
+    ax.set_ylabel(ylabel, fontsize=16)
+    # Rotate the GMPE labels for readability
+    for label in ax.get_xticklabels():
+        label.set_rotation(45)
+        label.set_horizontalalignment('right')
+    ax.tick_params(labelsize=14)
+    if ax.get_legend_handles_labels()[0]:
+        ax.legend(loc='upper left', bbox_to_anchor=(1, 1), fontsize=14, ncol=1, frameon=False)
+    # Keep the legend inside the saved image
+    fig.tight_layout()
+
+
+RENDERERS = {
+    'magnitude': render_magnitude,
+    'distance': render_distance,
+    'bar': render_bar,
+}
+
+
+# Draws and saves one figure, then releases it; returns the file name
+def render(kind, filename, dpi, output_format, data):
+    fig = _new_figure()
+    try:
+        RENDERERS[kind](fig, **data)
+        filename = f"{filename}.{output_format}"
+        fig.savefig(filename, dpi=dpi, format=output_format)
+    finally:
+        fig.clear()
+    return filename
+
+
+class RenderPool:
+    """
+    Renders figures in worker processes, or in the calling process with
+    workers=1. settings overrides PLOT_SETTINGS per plot type, e.g.
+    {'distance': {'dpi': 400, 'format': 'pdf'}}.
+    """
+    def __init__(self, workers=None, settings=None):
+        self.settings = {kind: dict(values) for kind, values in PLOT_SETTINGS.items()}
+        for kind, values in (settings or {}).items():
+            self.settings[kind].update(values)
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                initializer=_init_worker,
+                                                initargs=(current_style(),))
+        self.pending = set()
+        self.files = []
+
+    # Queues a figure of the given plot type; filename has no extension
+    def submit(self, kind, filename, **data):
+        settings = self.settings[kind]
+        args = (kind, filename, settings['dpi'], settings['format'], data)
+        if self.executor is None:
+            self.files.append(render(*args))
+            return
+        if len(self.pending) >= QUEUE_DEPTH * self.workers:
+            self._collect(FIRST_COMPLETED)
+        self.pending.add(self.executor.submit(render, *args))
+
+    def _collect(self, return_when):
+        done, self.pending = wait(self.pending, return_when=return_when)
+        for future in done:
+            # Raises the error of a failed figure
+            self.files.append(future.result())
+
+    # Waits for all queued figures and returns the saved file names
+    def join(self):
+        if self.pending:
+            self._collect(ALL_COMPLETED)
+        return self.files
+
+    def close(self, cancel=False):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=cancel)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if exc_type is None:
+                self.join()
+        finally:
+            self.close(cancel=exc_type is not None)